@@ -5,6 +5,8 @@ from trytond.pool import Pool
 from . import configuration
 from . import cart
 from . import inventory
+from . import location
+from . import shipment
 from . import user
 
 
@@ -14,7 +16,11 @@ def register():
         cart.StockCart,
         cart.StockShipmentOutCart,
         cart.StockShipmentOutCartLine,
+        cart.StockShipmentOutCartPickingQuantity,
+        cart.StockShipmentOutCartReservation,
         inventory.Inventory,
         inventory.InventoryLine,
+        location.Location,
+        shipment.ShipmentOut,
         user.User,
         module='stock_cart', type_='model')
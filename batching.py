@@ -0,0 +1,54 @@
+# This file is part of stock_cart module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Order batching heuristic to fill a cart with the orders that share picks.
+
+Orders are sets of pick keys like ('location', id), ('aisle', x) or
+('product', id) and the saving of adding an order to a batch is the weight of
+its keys already in the batch: the stops and walks it does not add.
+'''
+
+__all__ = ['KEY_WEIGHTS', 'batch_orders']
+
+KEY_WEIGHTS = {
+    'location': 2,
+    'product': 1,
+    'aisle': 1,
+    }
+
+
+def batch_orders(orders, limit, weights=KEY_WEIGHTS):
+    '''
+    Return the indexes of up to limit orders to pick together.
+    orders is a list of sets of pick keys in priority order. The first order
+    is the seed and then, one at a time, it is added the order with the
+    greatest saving, the one that adds less new keys and the first one by
+    priority.
+    '''
+    def weight(key):
+        return weights.get(key[0], 1)
+
+    # key: indexes of the orders with key
+    orders_by_key = {}
+    for index, keys in enumerate(orders):
+        for key in keys:
+            orders_by_key.setdefault(key, []).append(index)
+    totals = [sum(weight(k) for k in keys) for keys in orders]
+    savings = [0] * len(orders)
+    pending = set(range(len(orders)))
+    batch_keys = set()
+    batch = []
+    while pending and len(batch) < limit:
+        if batch:
+            index = min(pending, key=lambda i: (
+                    -savings[i], totals[i] - savings[i], i))
+        else:
+            index = min(pending)
+        pending.remove(index)
+        batch.append(index)
+        for key in orders[index] - batch_keys:
+            batch_keys.add(key)
+            for other in orders_by_key[key]:
+                savings[other] += weight(key)
+    return batch
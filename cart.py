@@ -1,24 +1,214 @@
 # This file is part of stock_cart module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from time import sleep
+import datetime
+import hashlib
+import json
+from bisect import bisect_right
+from itertools import chain, groupby, islice
+from random import uniform
+from time import sleep, time
 from decimal import Decimal
+from sql import Cast, Literal, Table
+from sql.aggregate import Count, Sum
+from sql.conditionals import Coalesce, NullIf
+from sql.functions import CurrentTimestamp
+from sql.operators import Concat, Exists
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
 from trytond.model import ModelView, ModelSQL, fields, Unique
 from trytond.pool import Pool
 from trytond.transaction import Transaction
 from trytond.pyson import Eval, Equal, Not
+from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
 from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
 import logging
 
-__all__ = ['StockCart', 'StockShipmentOutCart', 'StockShipmentOutCartLine']
+from .metrics import lock_counters, profiled, phase, add_value
+from .route import optimize_route
+from .batching import batch_orders
+
+__all__ = ['StockCart', 'StockShipmentOutCart', 'StockShipmentOutCartLine',
+    'StockShipmentOutCartPickingQuantity', 'StockShipmentOutCartReservation']
 
 
 logger = logging.getLogger(__name__)
+DatabaseOperationalError = backend.get('DatabaseOperationalError')
+DatabaseIntegrityError = backend.get('DatabaseIntegrityError')
+# Minimum number of shipments read at once to assign them to carts
+SHIPMENTS_BATCH = 100
+# Maximum number of shipments read to choose the ones to batch in a cart
+BATCH_CANDIDATES = 500
+# Seconds of the first retry to lock the carts table, doubled on each attempt
+LOCK_BACKOFF = 0.05
+# 2-opt passes of the Nearest Location route of the pick list pages
+PAGE_ROUTE_PASSES = 2
+# Minimum time between the lease renewals of the polled draft carts
+LEASE_RENEWAL = datetime.timedelta(minutes=1)
 STATES = {
     'readonly': Not(Equal(Eval('state'), 'draft')),
 }
 
 
+def is_lock_error(exception):
+    'Return True if the database exception is a lock conflict'
+    # PostgreSQL lock_not_available, raised by NOWAIT and lock_timeout
+    return getattr(exception, 'pgcode', None) == '55P03'
+
+
+def pick_entries(keys):
+    '''
+    Return the pick list entry of each (sequence, product_id) of keys and the
+    number of entries, where entries are sorted by location sequence.
+    A key is added to the product entry with the greatest sequence lower or
+    equal than its own, otherwise a new entry is created after all the
+    entries with a lower or equal sequence.
+    '''
+    sequences = []
+    # product ID: (ascending sequences, indexes) of its entries
+    by_product = {}
+    indexes = []
+    for sequence, product_id in keys:
+        product_sequences, product_indexes = by_product.setdefault(
+            product_id, ([], []))
+        index = bisect_right(product_sequences, sequence)
+        if index:
+            indexes.append(product_indexes[index - 1])
+        else:
+            # New entries always have the lowest sequence of the product
+            product_sequences.insert(0, sequence)
+            product_indexes.insert(0, len(sequences))
+            indexes.append(len(sequences))
+            sequences.append(sequence)
+    order = sorted(range(len(sequences)), key=lambda i: (sequences[i], i))
+    entries = [0] * len(sequences)
+    for entry, index in enumerate(order):
+        entries[index] = entry
+    return [entries[i] for i in indexes], len(entries)
+
+
+def add_partial_index(table_name, name, columns, where):
+    '''
+    Create the index name of the columns of table_name on the rows matching
+    where (SQL) if it does not exist and the database supports it
+    '''
+    cursor = Transaction().connection.cursor()
+    if backend.name() == 'postgresql':
+        catalog = Table('pg_indexes')
+        exists = catalog.select(catalog.indexname,
+            where=catalog.indexname == name)
+    elif backend.name() == 'sqlite':
+        catalog = Table('sqlite_master')
+        exists = catalog.select(catalog.name,
+            where=(catalog.type == 'index') & (catalog.name == name))
+    else:
+        return
+    cursor.execute(*exists)
+    if cursor.fetchone():
+        return
+    cursor.execute('CREATE INDEX "%s" ON "%s" (%s) WHERE %s' % (name,
+            table_name, ', '.join('"%s"' % c for c in columns), where))
+
+
+def group_by_product(moves, product_info):
+    '''
+    Return the pick list of moves grouped by product and sorted by location
+    sequence (see pick_entries).
+    moves is an iterable of (sequence, product_id, cart_id, shipment) tuples
+    in cart order, where shipment is the dict added to the product shipments.
+    product_info is a callable that returns the info dict of a product ID.
+    '''
+    moves = list(moves)
+    entries, count = pick_entries((m[0], m[1]) for m in moves)
+    products = [None] * count
+    for entry, (_, product_id, cart_id, shipment) in zip(entries, moves):
+        if products[entry] is None:
+            product = product_info(product_id)
+            product['shipments'] = [shipment]
+            product['carts'] = [cart_id]
+            product['quantity'] = shipment['quantity']
+            product['locations'] = []
+            products[entry] = {product_id: product}
+        else:
+            # Update current product because is already in the list
+            product = products[entry][product_id]
+            product['shipments'].append(shipment)
+            product['carts'].append(cart_id)
+            product['quantity'] += shipment['quantity']
+        if shipment['location'] not in product['locations']:
+            product['locations'].append(shipment['location'])
+    return products
+
+
+def compact_by_product(moves, product_info, location_name):
+    '''
+    Return the pick list of moves in compact format: tables of products,
+    locations and shipments in columns and the lines of the pick list in
+    columns that reference them by index, sorted like group_by_product.
+    moves is an iterable of (sequence, product_id, cart_id, shipment_id,
+    shipment_code, row, column, location_id, quantity) tuples in cart order.
+    product_info is a callable that returns the info dict of a product ID.
+    location_name is a callable that returns the name of a location ID.
+    '''
+    moves = list(moves)
+    entries, _ = pick_entries((m[0], m[1]) for m in moves)
+    products = {'id': []}
+    locations = {'id': [], 'name': []}
+    shipments = {
+        'id': [],
+        'code': [],
+        'cart': [],
+        'row': [],
+        'column': [],
+        }
+    lines = {
+        'entry': [],
+        'product': [],
+        'location': [],
+        'shipment': [],
+        'quantity': [],
+        }
+    product2index, location2index, shipment2index = {}, {}, {}
+    # sort is stable, so lines of an entry keep the cart order
+    for i in sorted(range(len(moves)), key=entries.__getitem__):
+        (_, product_id, cart_id, shipment_id, shipment_code, row, column,
+            location_id, quantity) = moves[i]
+        product = product2index.get(product_id)
+        if product is None:
+            product = product2index[product_id] = len(products['id'])
+            info = product_info(product_id)
+            info['id'] = product_id
+            for key in set(products) | set(info):
+                products.setdefault(key, [None] * product).append(
+                    info.get(key))
+        location = location2index.get(location_id)
+        if location is None:
+            location = location2index[location_id] = len(locations['id'])
+            locations['id'].append(location_id)
+            locations['name'].append(location_name(location_id))
+        shipment = shipment2index.get(shipment_id)
+        if shipment is None:
+            shipment = shipment2index[shipment_id] = len(shipments['id'])
+            shipments['id'].append(shipment_id)
+            shipments['code'].append(shipment_code)
+            shipments['cart'].append(cart_id)
+            shipments['row'].append(row)
+            shipments['column'].append(column)
+        lines['entry'].append(entries[i])
+        lines['product'].append(product)
+        lines['location'].append(location)
+        lines['shipment'].append(shipment)
+        lines['quantity'].append(quantity)
+    return {
+        'products': products,
+        'locations': locations,
+        'shipments': shipments,
+        'lines': lines,
+        }
+
+
 class StockCart(ModelSQL, ModelView):
     ' Stock Cart'
     __name__ = 'stock.cart'
@@ -61,9 +251,20 @@ class StockShipmentOutCart(ModelSQL, ModelView):
     user = fields.Many2One('res.user', 'User', required=True,
         states=STATES, depends=['state'])
     state = fields.Selection([
+        ('reserved', 'Reserved'),
         ('draft', 'Draft'),
         ('done', 'Done'),
         ], 'State', readonly=True)
+    row = fields.Integer('Row', readonly=True,
+        help='Row of the cart box of the shipment')
+    column = fields.Integer('Column', readonly=True,
+        help='Column of the cart box of the shipment')
+    lease_date = fields.DateTime('Lease Date', readonly=True,
+        help='Last activity of the user on the draft cart')
+    _locations_cache = Cache('stock_shipment_out_cart.user_locations',
+        context=False)
+    _pick_lists_cache = Cache('stock_shipment_out_cart.pick_lists',
+        context=False)
 
     @classmethod
     def __setup__(cls):
@@ -84,13 +285,36 @@ class StockShipmentOutCart(ModelSQL, ModelView):
             })
         cls.__rpc__.update({
             'get_products': RPC(readonly=False),
+            'get_products_changes': RPC(readonly=False),
+            'claim_shipments': RPC(readonly=False),
+            'get_products_page': RPC(),
             'done_cart': RPC(readonly=False),
+            'get_lock_statistics': RPC(),
+            'renew_leases': RPC(readonly=False),
             })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(StockShipmentOutCart, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['user', 'state'], 'add')
+        # Carts are done once picked, so only few carts are draft
+        add_partial_index(cls._table, cls._table + '_user_draft_index',
+            ['user'], "state = 'draft'")
+        add_partial_index(cls._table, cls._table + '_cart_draft_index',
+            ['cart', 'row', 'column'], "state = 'draft'")
+
     @staticmethod
     def default_state():
         return 'draft'
 
+    @staticmethod
+    def default_lease_date():
+        return datetime.datetime.now()
+
     @staticmethod
     def default_cart():
         User = Pool().get('res.user')
@@ -117,14 +341,7 @@ class StockShipmentOutCart(ModelSQL, ModelView):
             'state': 'draft',
             })
 
-        domain = ['OR']
-        for cart in carts:
-            domain.append([
-                ('shipment', '=', cart.shipment.id),
-                ('cart', '=', cart.cart.id),
-                ('user', '=', cart.user.id),
-            ])
-        lines_to_draft = CartLine.search(domain)
+        lines_to_draft = CartLine.browse(cls.get_line_ids(carts))
         if lines_to_draft:
             CartLine.draft(lines_to_draft)
 
@@ -132,18 +349,106 @@ class StockShipmentOutCart(ModelSQL, ModelView):
     def delete(cls, carts):
         CartLine = Pool().get('stock.shipment.out.cart.line')
 
-        domain = ['OR']
-        for cart in carts:
-            domain.append([
-                ('shipment', '=', cart.shipment.id),
-                ('cart', '=', cart.cart.id),
-                ('user', '=', cart.user.id),
-            ])
-        lines_to_delete = CartLine.search(domain)
+        lines_to_delete = CartLine.browse(cls.get_line_ids(carts))
         if lines_to_delete:
             CartLine.delete(lines_to_delete)
         super(StockShipmentOutCart, cls).delete(carts)
 
+    @classmethod
+    def get_line_ids(cls, carts):
+        '''
+        Return the IDs of the lines of the carts: the lines with the same
+        shipment, cart and user
+        '''
+        CartLine = Pool().get('stock.shipment.out.cart.line')
+        cart = cls.__table__()
+        line = CartLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        line_ids = []
+        for sub_carts in grouped_slice(carts):
+            cursor.execute(*cart.join(line,
+                    condition=(line.shipment == cart.shipment)
+                    & (line.cart == cart.cart)
+                    & (line.user == cart.user)
+                    ).select(line.id,
+                    where=reduce_ids(cart.id, [c.id for c in sub_carts])))
+            line_ids.extend(r[0] for r in cursor.fetchall())
+        return line_ids
+
+    @classmethod
+    def get_free_slots(cls, cart):
+        '''
+        Return the (row, column) boxes of the cart not used by draft
+        shipments, by row and column
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(table.row, table.column,
+                where=(table.cart == cart.id) & (table.state == 'draft')))
+        used = set(cursor.fetchall())
+        return [(row, column)
+            for row in range(1, cart.rows + 1)
+            for column in range(1, cart.columns + 1)
+            if (row, column) not in used]
+
+    @classmethod
+    def assign_slots(cls, carts):
+        'Assign a free box of their cart to the carts without one'
+        to_write = []
+        carts = sorted([c for c in carts if not c.row or not c.column],
+            key=lambda c: c.cart.id)
+        for cart, sub_carts in groupby(carts, key=lambda c: c.cart):
+            for record, (row, column) in zip(sub_carts,
+                    cls.get_free_slots(cart)):
+                to_write.extend(([record], {
+                            'row': row,
+                            'column': column,
+                            }))
+        if to_write:
+            cls.write(*to_write)
+
+    @classmethod
+    def get_user_location_ids(cls):
+        '''
+        Return the ids of the user stock locations, or the storage location
+        of the user warehouse (all warehouses if not set), and their children
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        User = pool.get('res.user')
+
+        user = User(Transaction().user)
+        if user.stock_locations:
+            key = ('locations',) + tuple(sorted(
+                    l.id for l in user.stock_locations))
+        elif user.stock_warehouse:
+            key = ('warehouse', user.stock_warehouse.id)
+        else:
+            key = ('warehouses',)
+        location_ids = cls._locations_cache.get(key)
+        if location_ids is not None:
+            return list(location_ids)
+
+        if user.stock_locations:
+            locations = list(user.stock_locations)
+        elif user.stock_warehouse:
+            locations = [user.stock_warehouse.storage_location]
+        else:
+            locations = []
+            for warehouse in Location.search([
+                    ('type', '=', 'warehouse'),
+                    ]):
+                locations.append(warehouse.storage_location)
+
+        locs = Location.search([
+                ('parent', 'child_of', [l.id for l in locations]),
+                ])
+        location_ids = list(set(l.id for l in locations + locs))
+        cls._locations_cache.set(key, location_ids)
+        return list(location_ids)
+
     @staticmethod
     def product_info(product):
         '''
@@ -155,7 +460,7 @@ class StockShipmentOutCart(ModelSQL, ModelView):
             }
 
     @classmethod
-    def get_products_by_carts(cls, carts):
+    def get_products_by_carts(cls, carts, protocol=1):
         '''
         Return a list of dictionaries like this:
         [{
@@ -169,94 +474,222 @@ class StockShipmentOutCart(ModelSQL, ModelView):
                             'id': shipment_id,
                             'code': code_value,
                             'quantity': quantity_value,
+                            'location': location_name,
+                            'row': row_value,
+                            'column': column_value,
                             },
+                        ],
+                    'locations': [
+                        location_name,
                         ]}},
             ]
-        Where products are sorted by location path
+        Where products are sorted by location path and row and column are
+        the cart box of the shipment
+        With protocol 2, shipments have also 'location_id' and products
+        'location_ids', so locations are saved by ID and names are only
+        displayed.
+        With protocol 3, it returns the compact format of
+        compact_by_product instead.
+        '''
+        location_ids = cls.get_user_location_ids()
+        rows = cls.get_moves_by_carts(carts, location_ids)
+        add_value('moves', len(rows))
+        return cls.get_products_by_moves(rows, protocol)
+
+    @staticmethod
+    def get_empty_products(protocol=1):
+        'Return the products of get_products_by_carts without moves'
+        if protocol >= 3:
+            return compact_by_product([], None, None)
+        return []
+
+    @classmethod
+    def get_products_by_moves(cls, rows, protocol=1):
+        '''
+        Return the products of get_products_by_carts of the moves returned
+        by get_moves_by_carts
         '''
         pool = Pool()
-        Location = Pool().get('stock.location')
-        User = pool.get('res.user')
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
 
-        user = User(Transaction().user)
+        products = dict((p.id, p) for p in Product.browse(
+                list(set(r[3] for r in rows))))
+        locations = dict((l.id, l) for l in Location.browse(
+                list(set(r[4] for r in rows))))
+        route = cls.get_route_sequences(locations.values())
+
+        def get_sequence(location_id, sequence):
+            # If location has not sequence, put it in the end
+            sequence = sequence or 1
+            if route is not None:
+                sequence = route.get(location_id, (1, sequence, 0))
+            return sequence
+
+        if protocol >= 3:
+            return compact_by_product(((get_sequence(location_id, sequence),
+                        product_id, cart_id, shipment_id, shipment_number,
+                        row, column, location_id, quantity)
+                    for (cart_id, shipment_id, shipment_number, product_id,
+                        location_id, sequence, quantity, row, column)
+                    in rows),
+                lambda product_id: cls.product_info(products[product_id]),
+                lambda location_id: locations[location_id].name)
+
+        moves = []
+        for (cart_id, shipment_id, shipment_number, product_id, location_id,
+                sequence, quantity, row, column) in rows:
+            shipment = {
+                'id': shipment_id,
+                'code': shipment_number,
+                'quantity': quantity,
+                # location name will be used later to find the location ID
+                'location': locations[location_id].name,
+                'row': row,
+                'column': column,
+                }
+            if protocol >= 2:
+                shipment['location_id'] = location_id
+            moves.append((get_sequence(location_id, sequence), product_id,
+                    cart_id, shipment))
+
+        products = group_by_product(moves,
+            lambda product_id: cls.product_info(products[product_id]))
+        if protocol >= 2:
+            for product in chain.from_iterable(
+                    p.itervalues() for p in products):
+                location_ids = []
+                for shipment in product['shipments']:
+                    if shipment['location_id'] not in location_ids:
+                        location_ids.append(shipment['location_id'])
+                product['location_ids'] = location_ids
+        return products
 
-        if user.stock_locations:
-            locations = list(user.stock_locations)
-        elif user.stock_warehouse:
-            locations = [user.stock_warehouse.storage_location]
-        else:
-            locations = []
-            for warehouse in Location.search([
-                    ('type', '=', 'warehouse'),
-                    ]):
-                locations.append(warehouse.storage_location)
+    @classmethod
+    def get_route_sequences(cls, locations, passes=None):
+        '''
+        Return a dict with location ID and its sequence in the pick route of
+        the stock configuration for the locations with pick X and Y, or None
+        to sort by location sequence.
+        With passes, the Nearest Location route is improved for that number
+        of 2-opt passes instead of the route time, so it is always the same.
+        '''
+        Configuration = Pool().get('stock.configuration')
 
-        locs = Location.search([
-                ('parent', 'child_of', [l.id for l in locations]),
-                ])
-        if locs:
-            locations += locs
-        location_ids = [l.id for l in locations]
-
-        products = []
-        for cart in carts:
-            shipment = cart.shipment
-            for move in shipment.inventory_moves:
-                if move.state != 'assigned':
-                    continue
-                if move.from_location.id not in location_ids:
-                    continue
-
-                # If location has not sequence, put it in the end
-                sequence = move.from_location.sequence or 1
-                index = len(products)
-                while index > 0 and products[index - 1][0] > sequence:
-                    index -= 1
-
-                jindex = index
-                while (jindex > 0
-                        # Check if different products have the same sequence
-                        and move.product.id not in products[jindex - 1][1]):
-                    jindex -= 1
+        config = Configuration(1)
+        if config.stock_cart_route in (None, 'sequence'):
+            return None
+        locations = [l for l in locations
+            if l.pick_x is not None and l.pick_y is not None]
+        # Locations in the same position are picked together by level
+        positions = sorted(set((l.pick_x, l.pick_y) for l in locations))
+        route = optimize_route(positions, config.stock_cart_route,
+            (config.stock_cart_route_time or 0) / 1000., passes=passes)
+        position2rank = dict((positions[i], rank)
+            for rank, i in enumerate(route))
+        return dict((l.id,
+                (0, position2rank[(l.pick_x, l.pick_y)], l.pick_level or 0))
+            for l in locations)
 
-                # location name will be used later to find the location ID
-                location = move.from_location.name
-
-                if jindex <= 0:
-                    # Append this product to the list
-                    product = cls.product_info(move.product)
-                    product['shipments'] = [{
-                            'id': shipment.id,
-                            'code': shipment.number,
-                            'quantity': move.quantity,
-                            'location': location,
-                            }]
-                    product['carts'] = [cart.id]
-                    product['quantity'] = move.quantity
-                    locations = product.get('locations', [])
-                    if not location in locations:
-                        locations.append(location)
-                    product['locations'] = locations
-                    products.insert(index, (sequence,
-                            {move.product.id: product}))
-                else:
-                    index = jindex
-                    # Update current product because is already in the list
-                    product = products[index - 1][1][move.product.id]
-                    product['shipments'].append({
-                                'id': shipment.id,
-                                'code': shipment.number,
-                                'quantity': move.quantity,
-                                'location': location,
-                                })
-                    product['carts'].append(cart.id)
-                    product['quantity'] += move.quantity
-                    locations = product.get('locations', [])
-                    if not location in locations:
-                        locations.append(location)
-                    product['locations'] = locations
-
-        return [p[1] for p in products]
+    @classmethod
+    def get_moves_by_carts(cls, carts, location_ids):
+        '''
+        Return the assigned inventory moves of the carts shipments from
+        location_ids as a list of tuples in cart order:
+        (cart_id, shipment_id, shipment_number, product_id, location_id,
+            location_sequence, quantity, row, column)
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        Shipment = pool.get('stock.shipment.out')
+        cart = cls.__table__()
+        shipment = Shipment.__table__()
+        warehouse = Location.__table__()
+        move = Move.__table__()
+        location = Location.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if not location_ids:
+            return []
+
+        rows = []
+        for sub_carts in grouped_slice(carts):
+            query = cart.join(shipment,
+                condition=cart.shipment == shipment.id
+                ).join(warehouse,
+                condition=shipment.warehouse == warehouse.id
+                ).join(move,
+                condition=(move.shipment == Concat(Shipment.__name__ + ',',
+                        Cast(shipment.id, 'VARCHAR')))
+                & (move.to_location == warehouse.output_location)
+                ).join(location,
+                condition=move.from_location == location.id
+                ).select(cart.id, shipment.id, shipment.number, move.product,
+                location.id, location.sequence, move.quantity, cart.row,
+                cart.column,
+                where=reduce_ids(cart.id, [c.id for c in sub_carts])
+                & (move.state == 'assigned')
+                & reduce_ids(move.from_location, location_ids),
+                # The order of shipment.inventory_moves, the default order
+                # of stock.move, that defines the pick list entries
+                order_by=move.id.desc)
+            cursor.execute(*query)
+            rows.extend(cursor.fetchall())
+
+        position = dict((c.id, i) for i, c in enumerate(carts))
+        rows.sort(key=lambda r: position[r[0]])
+        return rows
+
+    @classmethod
+    def get_pick_locations(cls, carts, location_ids):
+        '''
+        Return the locations of the assigned inventory moves of the carts
+        shipments from location_ids as a list of (location_id, moves) tuples
+        in pick order: the pick route or the location sequence.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        Shipment = pool.get('stock.shipment.out')
+        cart = cls.__table__()
+        shipment = Shipment.__table__()
+        warehouse = Location.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if not location_ids:
+            return []
+
+        moves = {}
+        for sub_carts in grouped_slice(carts):
+            query = cart.join(shipment,
+                condition=cart.shipment == shipment.id
+                ).join(warehouse,
+                condition=shipment.warehouse == warehouse.id
+                ).join(move,
+                condition=(move.shipment == Concat(Shipment.__name__ + ',',
+                        Cast(shipment.id, 'VARCHAR')))
+                & (move.to_location == warehouse.output_location)
+                ).select(move.from_location, Count(move.id),
+                where=reduce_ids(cart.id, [c.id for c in sub_carts])
+                & (move.state == 'assigned')
+                & reduce_ids(move.from_location, location_ids),
+                group_by=move.from_location)
+            cursor.execute(*query)
+            for location_id, count in cursor:
+                moves[location_id] = moves.get(location_id, 0) + count
+
+        locations = Location.browse(moves.keys())
+        # Pages resume after the last location of the previous one, so the
+        # route must not depend on the time it is improved
+        route = cls.get_route_sequences(locations,
+            passes=PAGE_ROUTE_PASSES) or {}
+        # If location has not sequence, put it in the end
+        keys = dict((l.id, route.get(l.id, (1, l.sequence or 1, 0)))
+            for l in locations)
+        return [(i, moves[i]) for i in sorted(moves,
+                key=lambda i: (keys[i], i))]
 
     @classmethod
     def append_domain(cls, domain):
@@ -266,8 +699,10 @@ class StockShipmentOutCart(ModelSQL, ModelView):
     def filter_domain_by_locations(cls, domain):
         pool = Pool()
         User = pool.get('res.user')
-        Location = pool.get('stock.location')
         Move = pool.get('stock.move')
+        Shipment = pool.get('stock.shipment.out')
+        shipment = Shipment.__table__()
+        move = Move.__table__()
 
         user = User(Transaction().user)
         locations = user.stock_locations
@@ -275,41 +710,696 @@ class StockShipmentOutCart(ModelSQL, ModelView):
             # search shipments are in user locations but not shipments
             # have other moves in others locations when user not have access
             # in locations preference
-            locs = Location.search([
-                    ('parent', 'child_of', [l.id for l in locations]),
-                    ])
-            locs_notin = Location.search([
-                    ('id', 'not in', [l.id for l in locs]),
-                    ])
-            moves_in = Move.search([
-                    ('state', '=', 'assigned'),
-                    ('from_location', 'in', [l.id for l in locs]),
-                    ('shipment', 'like', 'stock.shipment.out,%'),
-                    ])
-            moves_notin = Move.search([
-                    ('state', '=', 'assigned'),
-                    ('from_location', 'in', [l.id for l in locs_notin]),
-                    ('shipment', 'like', 'stock.shipment.out,%'),
-                    ])
-            shipments_exclude = [m.shipment.id for m in moves_notin]
-            moves = [m for m in moves_in if m.shipment.id not in shipments_exclude]
-            domain.append(('moves', 'in', [m.id for m in moves]))
+            in_locations = reduce_ids(move.from_location,
+                cls.get_user_location_ids())
+
+            def assigned_moves(where):
+                return Exists(move.select(move.id,
+                        where=(move.shipment == Concat(Shipment.__name__ + ',',
+                                Cast(shipment.id, 'VARCHAR')))
+                        & (move.state == 'assigned')
+                        & where))
+            query = shipment.select(shipment.id,
+                where=assigned_moves(in_locations)
+                & ~assigned_moves(~in_locations))
+            domain.append(('id', 'in', query))
 
     @classmethod
     def filter_shipments(cls, shipments):
         return shipments
 
     @classmethod
-    def get_products(cls, warehouse=None, state=['assigned'], attempts=0, total_attempts=5):
+    def claim_by_row_lock(cls):
+        '''
+        Return True if new shipments are claimed locking the shipment rows
+        instead of the carts table
+        '''
+        Configuration = Pool().get('stock.configuration')
+        transaction = Transaction()
+
+        config = Configuration(1)
+        if config.stock_cart_claim_method != 'row':
+            return False
+        # SKIP LOCKED is supported since PostgreSQL 9.5
+        if backend.name() != 'postgresql':
+            return False
+        return (transaction.database.get_version(transaction.connection)
+            >= (9, 5))
+
+    @classmethod
+    def lock_shipments(cls, shipment_ids, limit):
+        '''
+        Lock up to limit shipments skipping the ones locked by other
+        transactions and return their ids in the same order.
+        The concurrent transactions that try to lock them after this one is
+        committed fail with a serialization error.
+        '''
+        Shipment = Pool().get('stock.shipment.out')
+        shipment = Shipment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        locked = []
+        shipment_ids = iter(shipment_ids)
+        while len(locked) < limit:
+            sub_ids = list(islice(shipment_ids, limit - len(locked)))
+            if not sub_ids:
+                break
+            query, args = tuple(shipment.select(shipment.id,
+                    where=reduce_ids(shipment.id, sub_ids)))
+            cursor.execute(query + ' FOR UPDATE SKIP LOCKED', args)
+            ids = set(r[0] for r in cursor.fetchall())
+            if ids:
+                # A shipment claimed by a transaction committed after the
+                # snapshot is not locked anymore, so it would be claimed
+                # twice. Updating the rows makes that transaction fail to
+                # lock them with a serialization error that is retried.
+                cursor.execute(*shipment.update([shipment.write_date],
+                        [shipment.write_date],
+                        where=reduce_ids(shipment.id, list(ids))))
+            locked.extend(i for i in sub_ids if i in ids)
+        return locked
+
+    @classmethod
+    def get_batch_keys(cls, shipment_ids):
+        '''
+        Return a dict with shipment ID and the set of pick keys of its
+        assigned inventory moves from the user locations: location, product
+        and aisle (pick X) keys
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        Shipment = pool.get('stock.shipment.out')
+        shipment = Shipment.__table__()
+        warehouse = Location.__table__()
+        move = Move.__table__()
+        location = Location.__table__()
+        cursor = Transaction().connection.cursor()
+
+        keys = dict((i, set()) for i in shipment_ids)
+        location_ids = cls.get_user_location_ids()
+        if not location_ids:
+            return keys
+        for sub_ids in grouped_slice(shipment_ids):
+            query = shipment.join(warehouse,
+                condition=shipment.warehouse == warehouse.id
+                ).join(move,
+                condition=(move.shipment == Concat(Shipment.__name__ + ',',
+                        Cast(shipment.id, 'VARCHAR')))
+                & (move.to_location == warehouse.output_location)
+                ).join(location,
+                condition=move.from_location == location.id
+                ).select(shipment.id, move.product, location.id,
+                location.pick_x,
+                where=reduce_ids(shipment.id, sub_ids)
+                & (move.state == 'assigned')
+                & reduce_ids(move.from_location, location_ids))
+            cursor.execute(*query)
+            for shipment_id, product_id, location_id, pick_x in cursor:
+                shipment_keys = keys[shipment_id]
+                shipment_keys.add(('location', location_id))
+                shipment_keys.add(('product', product_id))
+                if pick_x is not None:
+                    shipment_keys.add(('aisle', pick_x))
+        return keys
+
+    @classmethod
+    def batch_shipments(cls, shipment_ids, limit):
+        '''
+        Return shipment_ids sorted to pick together the first limit ones:
+        the first shipment and the ones that share more locations and
+        products with it. The rest keep their order.
+        '''
+        keys = cls.get_batch_keys(shipment_ids)
+        batch = [shipment_ids[i] for i in batch_orders(
+                [keys[i] for i in shipment_ids], limit)]
+        batched = set(batch)
+        return batch + [i for i in shipment_ids if i not in batched]
+
+    @classmethod
+    def get_shipments_to_assign(cls, domain, limit, row_lock=False):
+        '''
+        Return up to limit shipment ids of domain not assigned to carts,
+        sorted by carrier sequence, planned date and create date.
+        Shipments are read in batches that are filtered with filter_shipments
+        and, with row_lock, locked until limit shipments are found.
+        With Order Batching assignment, the shipments planned within the
+        batch window of the first one are the candidates of batch_shipments.
+        '''
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        Shipment = pool.get('stock.shipment.out')
+        shipment = Shipment.__table__()
+        cart = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        config = Configuration(1)
+        batching = config.stock_cart_assignment == 'batch'
+        window = datetime.timedelta(days=config.stock_cart_batch_window or 0)
+
+        from_ = shipment
+        # Shipments without carrier sequence are the last ones
+        sequence = Literal(999)
+        if 'carrier' in Shipment._fields:
+            Carrier = pool.get('carrier')
+            if 'sequence' in Carrier._fields:
+                carrier = Carrier.__table__()
+                from_ = shipment.join(carrier, 'LEFT',
+                    condition=shipment.carrier == carrier.id)
+                sequence = Coalesce(NullIf(carrier.sequence, 0), 999)
+        query = from_.select(shipment.id, shipment.planned_date,
+            where=shipment.id.in_(Shipment.search(domain, query=True))
+            & ~Exists(cart.select(cart.id,
+                    where=cart.shipment == shipment.id)),
+            order_by=[sequence, shipment.planned_date.asc,
+                shipment.create_date.asc, shipment.id.asc],
+            limit=max(limit, SHIPMENTS_BATCH))
+
+        shipment_ids = []
+        max_date = None
+        query.offset = 0
+        while len(shipment_ids) < (BATCH_CANDIDATES if batching else limit):
+            cursor.execute(*query)
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            query.offset += len(rows)
+
+            if batching:
+                if query.offset == len(rows):
+                    max_date = rows[0][1] and rows[0][1] + window
+                # Due date priority: only the most urgent are batched
+                ids = [i for i, planned_date in rows
+                    if max_date is None
+                    or (planned_date and planned_date <= max_date)]
+            else:
+                ids = [r[0] for r in rows]
+            shipments = [s.id for s in cls.filter_shipments(
+                    Shipment.browse(ids))]
+            if row_lock and not batching:
+                # Other users skip the locked shipments and claim the next
+                shipments = cls.lock_shipments(shipments,
+                    limit - len(shipment_ids))
+            shipment_ids.extend(shipments)
+            if len(rows) < query.limit:
+                break
+            if batching and query.offset >= BATCH_CANDIDATES:
+                break
+        if batching and shipment_ids:
+            shipment_ids = cls.batch_shipments(shipment_ids, limit)
+            if row_lock:
+                shipment_ids = cls.lock_shipments(shipment_ids, limit)
+        return shipment_ids[:limit]
+
+    @classmethod
+    def lock_carts(cls, attempts=0, total_attempts=5):
+        '''
+        Lock the carts table retrying with a jittered backoff when it is
+        locked by other transactions.
+        Return False if it is not locked after total_attempts or the maximum
+        wait of the stock configuration.
+        '''
+        Configuration = Pool().get('stock.configuration')
+        transaction = Transaction()
+        database = transaction.database
+        connection = transaction.connection
+        cursor = connection.cursor()
+
+        config = Configuration(1)
+        timeout = config.stock_cart_lock_timeout or 0
+        max_wait = (config.stock_cart_lock_max_wait or 0) / 1000.
+        # Without savepoint, a failed lock aborts the transaction
+        savepoint = backend.name() == 'postgresql'
+
+        start = time()
+        while True:
+            attempts += 1
+            lock_counters.add('attempts')
+            if savepoint:
+                cursor.execute('SAVEPOINT stock_cart_lock')
+            try:
+                if savepoint and timeout:
+                    # The database waits the lock instead of the worker
+                    cursor.execute('SET LOCAL lock_timeout = %d' % timeout)
+                    cursor.execute('LOCK "%s" IN EXCLUSIVE MODE' % cls._table)
+                    cursor.execute('SET LOCAL lock_timeout = DEFAULT')
+                else:
+                    database.lock(connection, cls._table)
+            except DatabaseOperationalError as exception:
+                if not savepoint or not is_lock_error(exception):
+                    raise
+                cursor.execute('ROLLBACK TO SAVEPOINT stock_cart_lock')
+                lock_counters.add('conflicts')
+                add_value('lock_conflicts', 1)
+            else:
+                if savepoint:
+                    cursor.execute('RELEASE SAVEPOINT stock_cart_lock')
+                lock_counters.add('wait_time', time() - start)
+                add_value('lock_wait', time() - start)
+                return True
+
+            elapsed = time() - start
+            if attempts >= total_attempts or elapsed >= max_wait:
+                lock_counters.add('wait_time', elapsed)
+                lock_counters.add('give_ups')
+                add_value('lock_wait', elapsed)
+                logger.warning('Table Carts is lock after %s attempts and '
+                    '%.2f seconds' % (attempts, elapsed))
+                return False
+            sleep(min(uniform(0, LOCK_BACKOFF * 2 ** attempts),
+                    max_wait - elapsed))
+
+    @classmethod
+    def get_lock_statistics(cls):
+        '''
+        Return the carts table lock counters of the server process - RPC
+        '''
+        return lock_counters.values()
+
+    @classmethod
+    @profiled('get_products')
+    def get_products(cls, warehouse=None, state=['assigned'], attempts=0,
+            total_attempts=5, protocol=1):
         '''
         Return a list shipments - RPC
         @param warehouse: ID warehouse domain to search shipments
         @param state: list. Shipment states to filter
-        @param attempts: int. Attempts when table is lock
+        @param attempts: int. Attempts already done to lock the table
         @param total_attempts: int. Total attempts to try get shipments unlock
+        @param protocol: int. 2 to add location IDs and 3 for the compact
+            format (see get_products_by_carts)
+        '''
+        with phase('take_reservation'):
+            products = cls.take_reservation(protocol)
+        if products is not None:
+            return products
+        carts = cls.claim_carts(warehouse, state, attempts, total_attempts)
+        if carts:
+            with phase('get_products_by_carts'):
+                return cls.get_products_by_carts(carts, protocol)
+        return cls.get_empty_products(protocol)
+
+    @classmethod
+    def get_products_changes(cls, version=None, warehouse=None,
+            state=['assigned'], attempts=0, total_attempts=5, protocol=1):
+        '''
+        Return the changes of get_products since version - RPC
+        Return a dictionary with the 'version' of the pick list and:
+            - 'products': the get_products list if version is unknown
+            - otherwise, the changes since version:
+                'removed': shipment IDs no longer in the pick list
+                'added': get_products list of the new shipment moves
+                'quantities': [{'shipment', 'product', 'location_id',
+                    'quantity'}] of the changed moves, quantity 0 when they
+                    are no longer assigned
+            Both are empty if nothing changed.
+        @param version: string. Version of the last answer
+        Other parameters are the ones of get_products
+        '''
+        user = Transaction().user
+
+        # Polling does not lock the carts table while the user has carts
+        carts = cls.get_draft_carts()
+        if carts:
+            renewal = datetime.datetime.now() - LEASE_RENEWAL
+            if any(c.lease_date is None or c.lease_date < renewal
+                    for c in carts):
+                cls.renew_leases()
+        else:
+            carts = cls.claim_carts(warehouse, state, attempts,
+                total_attempts)
+        rows = cls.get_moves_by_carts(carts, cls.get_user_location_ids())
+        new_version = hashlib.sha1(repr(rows)).hexdigest()
+        if version == new_version:
+            return {
+                'version': version,
+                'removed': [],
+                'added': [],
+                'quantities': [],
+                }
+        cls._pick_lists_cache.set((user, new_version), rows)
+        old_rows = None
+        if version:
+            old_rows = cls._pick_lists_cache.get((user, version))
+        if old_rows is None:
+            return {
+                'version': new_version,
+                'products': cls.get_products_by_moves(rows, protocol),
+                }
+
+        def quantities(rows):
+            # (shipment_id, product_id, location_id): quantity
+            result = {}
+            for row in rows:
+                key = (row[1], row[3], row[4])
+                result[key] = result.get(key, 0) + row[6]
+            return result
+        old_quantities = quantities(old_rows)
+        new_quantities = quantities(rows)
+        shipment_ids = set(r[1] for r in rows)
+        changes = []
+        for key, quantity in old_quantities.iteritems():
+            if key[0] in shipment_ids:
+                new_quantity = new_quantities.get(key, 0)
+                if new_quantity != quantity:
+                    changes.append({
+                            'shipment': key[0],
+                            'product': key[1],
+                            'location_id': key[2],
+                            'quantity': new_quantity,
+                            })
+        return {
+            'version': new_version,
+            'removed': sorted(set(r[1] for r in old_rows) - shipment_ids),
+            'added': cls.get_products_by_moves([r for r in rows
+                    if (r[1], r[3], r[4]) not in old_quantities], protocol),
+            'quantities': changes,
+            }
+
+    @classmethod
+    def claim_shipments(cls, warehouse=None, state=['assigned'], attempts=0,
+            total_attempts=5):
+        '''
+        Claim the shipments of the user cart and return their IDs - RPC
+        The pick list is then read with get_products_page, out of the
+        claiming transaction.
+        Parameters are the ones of get_products.
+        '''
+        return [c.shipment.id for c in cls.claim_carts(warehouse, state,
+                attempts, total_attempts)]
+
+    @classmethod
+    def get_products_page(cls, cursor=None, size=500, protocol=1):
+        '''
+        Return a page of the pick list of the draft carts of the user - RPC
+        Return a dictionary with:
+            - 'products': get_products list of the moves of the next
+                locations in pick order, up to size moves but at least one
+                location
+            - 'cursor': the cursor of the next page or None if it is the last
+        @param cursor: string. Cursor of the page, None for the first one
+        @param size: int. Maximum number of moves of the page
+        @param protocol: int. See get_products
+        '''
+        carts = cls.get_draft_carts()
+        if not carts:
+            return {
+                'products': cls.get_empty_products(protocol),
+                'cursor': None,
+                }
+        locations = cls.get_pick_locations(carts, cls.get_user_location_ids())
+
+        start = 0
+        if cursor:
+            # Restart after the last location of the previous page even if
+            # the pick order has changed since then
+            position, last_id = map(int, cursor.split(':'))
+            location_ids = [l[0] for l in locations]
+            if last_id in location_ids:
+                start = location_ids.index(last_id) + 1
+            else:
+                start = position
+        page = []
+        moves = 0
+        for location_id, count in locations[start:]:
+            if page and moves + count > size:
+                break
+            page.append(location_id)
+            moves += count
+        end = start + len(page)
+
+        rows = cls.get_moves_by_carts(carts, page)
+        return {
+            'products': cls.get_products_by_moves(rows, protocol),
+            'cursor': ('%s:%s' % (end, page[-1])
+                if end < len(locations) else None),
+            }
+
+    @classmethod
+    def get_draft_carts(cls):
+        'Return the draft carts of the user cart without locking them'
+        User = Pool().get('res.user')
+
+        user = User(Transaction().user)
+        if not user.cart:
+            return []
+        return cls.search([
+                ('state', '=', 'draft'),
+                ('user', '=', user),
+                ], limit=user.cart.rows * user.cart.columns)
+
+    @classmethod
+    def take_reservation(cls, protocol=1):
+        '''
+        Return the pick list of the reserved carts of the user, that are
+        changed to draft, if the user has no draft carts. Otherwise None.
+        The pick list prepared by prepare_carts is returned if it is of the
+        same protocol.
+        Only with the prepare_carts option of the stock_cart section of the
+        configuration file.
+        '''
+        pool = Pool()
+        Reservation = pool.get('stock.shipment.out.cart.reservation')
+
+        if not config.getboolean('stock_cart', 'prepare_carts',
+                default=False):
+            return None
+        user = Transaction().user
+        # The reservation is created by reserve_pick_list
+        reservations = Reservation.search([
+                ('user', '=', user),
+                ], limit=1)
+        if not reservations:
+            return None
+        reservation, = reservations
+        if not reservation.pick_list:
+            # The next pick list is prepared with the protocol of the user
+            if reservation.protocol != protocol:
+                Reservation.write([reservation], {
+                        'protocol': protocol,
+                        })
+            return None
+        if cls.search([
+                    ('state', '=', 'draft'),
+                    ('user', '=', user),
+                    ], limit=1):
+            return None
+
+        products = None
+        if reservation.protocol == protocol:
+            products = reservation.load_pick_list()
+        else:
+            Reservation.write([reservation], {
+                    'protocol': protocol,
+                    })
+        carts = cls.take_reserved_carts()
+        if not carts:
+            # The carts were released, so is the pick list
+            Reservation.write([reservation], {
+                    'pick_list': None,
+                    'date': None,
+                    })
+            return None
+        if products is None:
+            products = cls.get_products_by_carts(carts, protocol)
+        return products
+
+    @classmethod
+    def take_reserved_carts(cls):
+        '''
+        Change the reserved carts of the user to draft, clear their prepared
+        pick list and return them
+        '''
+        pool = Pool()
+        Reservation = pool.get('stock.shipment.out.cart.reservation')
+
+        user = Transaction().user
+        carts = cls.search([
+                ('state', '=', 'reserved'),
+                ('user', '=', user),
+                ])
+        if carts:
+            cls.write(carts, {
+                    'state': 'draft',
+                    'lease_date': datetime.datetime.now(),
+                    })
+            reservations = Reservation.search([
+                    ('user', '=', user),
+                    ('pick_list', '!=', None),
+                    ])
+            if reservations:
+                Reservation.write(reservations, {
+                        'pick_list': None,
+                        'date': None,
+                        })
+        return carts
+
+    @classmethod
+    def prepare_carts(cls):
+        '''
+        Reserve the shipments of the next cart of the users with draft carts
+        and prepare their pick list - Cron
+        '''
+        pool = Pool()
+        User = pool.get('res.user')
+        transaction = Transaction()
+
+        with transaction.new_transaction() as new_transaction:
+            cls.release_reservations()
+            new_transaction.commit()
+
+        with transaction.set_user(0):
+            users = User.search([
+                    ('cart', '!=', None),
+                    ])
+            # Only the users that are picking need a next cart, unless it is
+            # already reserved even if its pick list could not be prepared
+            cart = cls.__table__()
+            cursor = transaction.connection.cursor()
+            cursor.execute(*cart.select(cart.user, cart.state,
+                    where=cart.state.in_(['draft', 'reserved'])
+                    & reduce_ids(cart.user, [u.id for u in users]),
+                    group_by=[cart.user, cart.state]))
+            pickers, reserved = set(), set()
+            for user_id, state in cursor.fetchall():
+                if state == 'draft':
+                    pickers.add(user_id)
+                else:
+                    reserved.add(user_id)
+
+        for user in users:
+            if user.id not in pickers or user.id in reserved:
+                continue
+            # Each user is claimed in its own transaction, committed before
+            # building the pick list, so the carts lock is held only to claim
+            # and the pickers do not wait for the whole cron
+            with transaction.new_transaction() as new_transaction, \
+                    new_transaction.set_user(user.id), \
+                    new_transaction.set_context(
+                        User.get_preferences(context_only=True)):
+                try:
+                    carts = cls.claim_carts(reserve=True)
+                    new_transaction.commit()
+                    if carts:
+                        cls.reserve_pick_list(carts)
+                        new_transaction.commit()
+                except Exception:
+                    new_transaction.rollback()
+                    logger.error('Next cart of user %s can not be prepared'
+                        % user.rec_name, exc_info=True)
+
+    @classmethod
+    def reserve_pick_list(cls, carts):
+        '''
+        Save the pick list of the reserved carts of the user with the
+        protocol of its last call
+        '''
+        pool = Pool()
+        Reservation = pool.get('stock.shipment.out.cart.reservation')
+        transaction = Transaction()
+
+        user = transaction.user
+        with transaction.set_user(0):
+            reservations = Reservation.search([
+                    ('user', '=', user),
+                    ], limit=1)
+        if reservations:
+            reservation, = reservations
+        else:
+            reservation = Reservation(user=user, protocol=1)
+        reservation.dump_pick_list(cls.get_products_by_carts(carts,
+                reservation.protocol))
+        reservation.date = datetime.datetime.now()
+        with transaction.set_user(0):
+            reservation.save()
+
+    @classmethod
+    def release_reservations(cls):
+        '''
+        Delete the reserved carts and pick lists older than the reservation
+        time of the stock configuration
+        '''
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        Reservation = pool.get('stock.shipment.out.cart.reservation')
+
+        config = Configuration(1)
+        limit = datetime.datetime.now() - datetime.timedelta(
+            minutes=config.stock_cart_reservation_time or 0)
+        carts = cls.search([
+                ('state', '=', 'reserved'),
+                ('create_date', '<', limit),
+                ])
+        if carts:
+            cls.delete(carts)
+        reservations = Reservation.search([
+                ('date', '<', limit),
+                ])
+        if reservations:
+            Reservation.write(reservations, {
+                    'pick_list': None,
+                    'date': None,
+                    })
+
+    @classmethod
+    def renew_leases(cls):
+        '''
+        Renew the lease of the draft carts of the user - RPC
+        The handheld calls it while picking if it does not call other RPCs,
+        so the carts are not reclaimed.
+        '''
+        cart = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        # Only the lease is updated, without the write date and user
+        cursor.execute(*cart.update([cart.lease_date],
+                [datetime.datetime.now()],
+                where=(cart.state == 'draft')
+                & (cart.user == transaction.user)))
+
+    @classmethod
+    def reclaim_carts(cls):
+        '''
+        Delete the draft carts without pickings of the users inactive for
+        longer than the lease time of the stock configuration - Cron
+        '''
+        pool = Pool()
+        Configuration = pool.get('stock.configuration')
+        CartLine = pool.get('stock.shipment.out.cart.line')
+        cart = cls.__table__()
+        line = CartLine.__table__()
+        cursor = Transaction().connection.cursor()
+
+        config = Configuration(1)
+        if not config.stock_cart_lease_time:
+            return
+        limit = datetime.datetime.now() - datetime.timedelta(
+            minutes=config.stock_cart_lease_time)
+        # The products picked are already in the cart, so the shipments with
+        # pickings are left to the user
+        cursor.execute(*cart.select(cart.id,
+                where=(cart.state == 'draft')
+                & (Coalesce(cart.lease_date, cart.create_date) < limit)
+                & ~Exists(line.select(line.id,
+                        where=(line.shipment == cart.shipment)
+                        & (line.cart == cart.cart)
+                        & (line.user == cart.user)))))
+        carts = cls.browse([r[0] for r in cursor.fetchall()])
+        if carts:
+            logger.info('Reclaim %s shipments of expired carts' % len(carts))
+            cls.delete(carts)
+
+    @classmethod
+    def claim_carts(cls, warehouse=None, state=['assigned'], attempts=0,
+            total_attempts=5, reserve=False):
+        '''
+        Return the draft carts of the user, its reserved carts or claim new
+        shipments for the boxes of the user cart and return their carts.
+        With reserve, new shipments are always claimed in reserved carts.
+        Other parameters are the ones of get_products.
         '''
         pool = Pool()
-        Shipment = pool.get('stock.shipment.out')
         Carts = pool.get('stock.shipment.out.cart')
         User = pool.get('res.user')
 
@@ -325,56 +1415,63 @@ class StockShipmentOutCart(ModelSQL, ModelView):
         domain = [('state', 'in', state)]
         if warehouse:
             domain.append(('warehouse', '=', warehouse))
-        cls.filter_domain_by_locations(domain)
-        cls.append_domain(domain)
-        try:
-            # Locks transaction. Nobody can query this table
-            transaction.database.lock(Transaction().connection, Carts._table)
-        except:
-            # Table is locked. Captures operational error and returns void list
-            if attempts < total_attempts:
-                sleep(0.5)
-                return cls.get_products(warehouse, state, attempts + 1,
-                    total_attempts)
-            else:
-                logger.warning(
-                    'Table Carts is lock after %s attempts' % (total_attempts))
+        with phase('filter_domain_by_locations'):
+            cls.filter_domain_by_locations(domain)
+            cls.append_domain(domain)
+        row_lock = cls.claim_by_row_lock()
+        if not row_lock:
+            with phase('lock_carts'):
+                locked = cls.lock_carts(attempts, total_attempts)
+            if not locked:
                 return []
+
+        # if there are carts state draft, return first this carts
+        carts = []
+        if not reserve:
+            with phase('draft_carts'):
+                carts = Carts.search([
+                    ('state', '=', 'draft'),
+                    ('user', '=', user),
+                    ], limit=baskets)
+                if carts:
+                    # Carts claimed before the boxes were saved
+                    cls.assign_slots(carts)
+                    cls.renew_leases()
+                else:
+                    carts = cls.take_reserved_carts()
+        if carts:
+            add_value('carts', len(carts))
+            return carts
+
+        # Assign new shipments
+        with phase('get_shipments_to_assign'):
+            shipments_cart = cls.get_shipments_to_assign(domain, baskets,
+                row_lock)
+        add_value('shipments', len(shipments_cart))
+
+        # Save carts assigned to user
+        to_create = []
+        if reserve:
+            # Reserved carts are taken when the draft ones are done
+            slots = [(r, c) for r in range(1, user.cart.rows + 1)
+                for c in range(1, user.cart.columns + 1)]
         else:
-            # if there are carts state draft, return first this carts
-            carts = Carts.search([
-                ('state', '=', 'draft'),
-                ('user', '=', user),
-                ], limit=baskets)
-            if carts:
-                return cls.get_products_by_carts(carts)
-
-            # Assign new shipments
-            shipments = Shipment.search(domain,
-                order=[('planned_date', 'ASC'), ('create_date', 'ASC')])
-            shipments = cls.filter_shipments(shipments)
-
-            pickings = [{'id': s.id, 'sequence': s.carrier.sequence or 999
-                if hasattr(s, 'carrier') and s.carrier else 999} for s in shipments]
-            shipments = [s['id'] for s in sorted(pickings, key=lambda k: k['sequence'])]
-
-            carts_assigned = [c.shipment.id for c in Carts.search([
-                ('shipment', 'in', shipments),
-                ])]
-
-            # Respect shipments order
-            shipments_cart = [s for s in shipments if s not in carts_assigned]
-
-            # Save carts assigned to user
-            to_create = []
-            for s in shipments_cart[:baskets]: # get limit from baskets
-                to_create.append({'shipment': s})
-            if to_create:
-                carts = Carts.create(to_create)
-                return cls.get_products_by_carts(carts)
+            slots = cls.get_free_slots(user.cart)
+        for s, (row, column) in zip(shipments_cart, slots):
+            to_create.append({
+                    'shipment': s,
+                    'row': row,
+                    'column': column,
+                    'state': 'reserved' if reserve else 'draft',
+                    })
+        if to_create:
+            add_value('carts', len(to_create))
+            with phase('create_carts'):
+                return Carts.create(to_create)
         return []
 
     @classmethod
+    @profiled('done_cart')
     def done_cart(cls, shipments):
         '''
         Done carts - RPC
@@ -384,16 +1481,20 @@ class StockShipmentOutCart(ModelSQL, ModelView):
         Carts = pool.get('stock.shipment.out.cart')
         ShipmentOut = pool.get('stock.shipment.out')
 
-        shipments = ShipmentOut.search([
-                ('code', 'in', shipments),
-                ])
+        with phase('search_shipments'):
+            shipments = ShipmentOut.search([
+                    ('code', 'in', shipments),
+                    ])
 
         if shipments:
-            carts = Carts.search([
-                ('state', '=', 'draft'),
-                ('shipment', 'in', shipments),
-                ])
-            Carts.done(carts)
+            with phase('search_carts'):
+                carts = Carts.search([
+                    ('state', '=', 'draft'),
+                    ('shipment', 'in', shipments),
+                    ])
+            add_value('carts', len(carts))
+            with phase('done'):
+                Carts.done(carts)
 
     @classmethod
     def print_shipments(cls, shipments):
@@ -448,6 +1549,16 @@ class StockShipmentOutCartLine(ModelSQL, ModelView):
                 },
             })
 
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        super(StockShipmentOutCartLine, cls).__register__(module_name)
+
+        table = TableHandler(cls, module_name)
+        table.index_action(['shipment', 'cart', 'user'], 'add')
+        table.index_action(['from_location', 'product'], 'add')
+
     @staticmethod
     def default_cart():
         User = Pool().get('res.user')
@@ -478,6 +1589,48 @@ class StockShipmentOutCartLine(ModelSQL, ModelView):
         if self.product:
             self.uom = self.product.default_uom
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        PickingQuantity = pool.get('stock.shipment.out.cart.picking_quantity')
+
+        lines = super(StockShipmentOutCartLine, cls).create(vlist)
+        new = PickingQuantity.get_line_quantities(
+            line_ids=[l.id for l in lines])
+        PickingQuantity.update_quantities({}, new)
+        return lines
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        PickingQuantity = pool.get('stock.shipment.out.cart.picking_quantity')
+
+        # Only the lines whose picking quantity may change
+        quantity_fields = set(['shipment', 'from_location', 'product',
+                'quantity'])
+        line_ids = set()
+        actions = iter(args)
+        for lines, values in zip(actions, actions):
+            if quantity_fields & set(values):
+                line_ids.update(l.id for l in lines)
+        line_ids = list(line_ids)
+        if line_ids:
+            old = PickingQuantity.get_line_quantities(line_ids=line_ids)
+        super(StockShipmentOutCartLine, cls).write(*args)
+        if line_ids:
+            PickingQuantity.update_quantities(old,
+                PickingQuantity.get_line_quantities(line_ids=line_ids))
+
+    @classmethod
+    def delete(cls, lines):
+        pool = Pool()
+        PickingQuantity = pool.get('stock.shipment.out.cart.picking_quantity')
+
+        old = PickingQuantity.get_line_quantities(
+            line_ids=[l.id for l in lines])
+        super(StockShipmentOutCartLine, cls).delete(lines)
+        PickingQuantity.update_quantities(old, {})
+
     @classmethod
     @ModelView.button
     def done(cls, lines):
@@ -493,78 +1646,386 @@ class StockShipmentOutCartLine(ModelSQL, ModelView):
             })
 
     @classmethod
+    @profiled('save_pickings')
     def save_pickings(cls, pickings):
-        'Save pickings lines'
-        # pickings = {shipment: {product: qty}}
+        '''
+        Save pickings lines
+        pickings is a dict {shipment_number: picking} or a list of pickings
+        with the shipment_number in the 'shipment' key, where picking is a dict
+        with the keys: product, qty, location, status and optionally cart (ID,
+        user cart by default)
+        location is the location name, or location_id the location ID
+        instead (protocol 2 of get_products)
+        '''
         pool = Pool()
         User = pool.get('res.user')
+        Cart = pool.get('stock.shipment.out.cart')
         ShipmentOut = pool.get('stock.shipment.out')
         Product = pool.get('product.product')
+        Template = pool.get('product.template')
         Location = pool.get('stock.location')
         Configuration = pool.get('stock.configuration')
+        line = cls.__table__()
+        shipment = ShipmentOut.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        cursor = Transaction().connection.cursor()
 
         user = User(Transaction().user)
         cart = user.cart if user.cart else None
 
+        if isinstance(pickings, dict):
+            pickings = [dict(v, shipment=k) for k, v in pickings.iteritems()]
         if not pickings or not cart:
             return
+        Cart.renew_leases()
 
         config = Configuration(1)
         create_issue = config.stock_cart_create_issue or False
 
-        domain = ['OR']
-        shipments = []
-        products = []
-        locations = []
-        for shipment_number, v in pickings.iteritems():
-            if v['status'] == 'done':
-                domain.append([
-                    ('shipment.number', '=', shipment_number),
-                    ('cart', '=', cart.id),
-                    ('user', '=', user.id),
-                ])
-                shipments.append(shipment_number)
-                products.append(int(v['product']))
-                locations.append(v['location'])
+        done = []
+        for picking in pickings:
+            if picking['status'] == 'done':
+                done.append(picking)
             elif create_issue:
-                cls.create_issue(shipment_number, v['status'],
-                    v['product'], v['qty'], v['location'])
+                cls.create_issue(picking['shipment'], picking['status'],
+                    picking['product'], picking['qty'], picking['location'])
 
-        if not shipments:
+        add_value('pickings', len(pickings))
+        if not done:
             return
 
-        shipments = dict((s.number, s) for s in ShipmentOut.search([
-                ('number', 'in', shipments),
-                ]))
-        products = dict((p.id, p) for p in Product.search([
-                ('id', 'in', products),
-                ]))
-        locations = dict((s.name, s) for s in Location.search([
-                ('name', 'in', locations),
-                ]))
+        numbers = list(set(p['shipment'] for p in done))
+        product_ids = list(set(int(p['product']) for p in done))
+        cart_ids = list(set(int(p.get('cart') or cart.id) for p in done))
 
-        picking_lines = []
-        for line in cls.search(domain):
-            # TODO all products has a product number
-            picking_lines.append((line.shipment.number, line.product.id))
+        shipments = dict((s.number, s.id) for s in ShipmentOut.search([
+                ('number', 'in', numbers),
+                ]))
+        # Protocol 2 sends location IDs and older ones location names
+        names = set(p['location'] for p in done if not p.get('location_id'))
+        locations = {}
+        if names:
+            locations.update((l.name, l.id) for l in Location.search([
+                        ('name', 'in', list(names)),
+                        ]))
+        location_ids = set(int(p['location_id']) for p in done
+            if p.get('location_id'))
+        if location_ids:
+            locations.update((l.id, l.id) for l in Location.search([
+                        ('id', 'in', list(location_ids)),
+                        ]))
+
+        uoms = {}
+        for sub_ids in grouped_slice(product_ids):
+            cursor.execute(*product.join(template,
+                    condition=product.template == template.id
+                    ).select(product.id, template.default_uom,
+                    where=reduce_ids(product.id, list(sub_ids))))
+            uoms.update(cursor.fetchall())
+
+        # (shipment number, product ID, cart ID) already picked
+        picked = set()
+        for sub_numbers in grouped_slice(numbers):
+            cursor.execute(*line.join(shipment,
+                    condition=line.shipment == shipment.id
+                    ).select(shipment.number, line.product, line.cart,
+                    where=shipment.number.in_(list(sub_numbers))
+                    & line.cart.in_(cart_ids)
+                    & (line.user == user.id)))
+            picked.update(cursor.fetchall())
 
         to_create = []
-        for shipment_number, v in pickings.iteritems():
-            product_id = int(v['product'])
-            qty = Decimal(v['qty'])
+        for picking in done:
+            shipment_number = picking['shipment']
+            product_id = int(picking['product'])
+            cart_id = int(picking.get('cart') or cart.id)
+            qty = Decimal(picking['qty'])
+            if picking.get('location_id'):
+                location = int(picking['location_id'])
+            else:
+                location = picking['location']
 
-            if (shipment_number, product_id) in picking_lines:
+            key = (shipment_number, product_id, cart_id)
+            if key in picked:
                 continue
-            if not locations.get(v['location']):
+            if not locations.get(location):
                 continue
+            if shipment_number not in shipments or product_id not in uoms:
+                continue
+            picked.add(key)
+
+            to_create.append({
+                    'shipment': shipments[shipment_number],
+                    'from_location': locations[location],
+                    'product': product_id,
+                    'uom': uoms[product_id],
+                    'quantity': qty,
+                    'cart': cart_id,
+                    })
+
+        add_value('lines', len(to_create))
+        if to_create:
+            with phase('create'):
+                cls.create(to_create)
 
-            new_line = cls()
-            new_line.shipment = shipments[shipment_number]
-            new_line.from_location = locations[v['location']]
-            new_line.product = products[product_id]
-            new_line.quantity = qty
-            new_line.on_change_product()
-            to_create.append(new_line._save_values)
 
-        if to_create:
-            cls.create(to_create)
+class StockShipmentOutCartPickingQuantity(ModelSQL):
+    'Stock Shipment Out Cart Picking Quantity'
+    __name__ = 'stock.shipment.out.cart.picking_quantity'
+    location = fields.Many2One('stock.location', 'Location', required=True,
+        ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        ondelete='CASCADE')
+    quantity = fields.Float('Quantity', required=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(StockShipmentOutCartPickingQuantity, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('location_product_uniq', Unique(t, t.location, t.product),
+                'The location and product must be unique!'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        TableHandler = backend.get('TableHandler')
+
+        exist = TableHandler.table_exist(cls._table)
+        super(StockShipmentOutCartPickingQuantity, cls).__register__(
+            module_name)
+        if not exist:
+            cls.rebuild()
+
+    @classmethod
+    def get_line_quantities(cls, line_ids=None, shipment_ids=None):
+        '''
+        Return a dict with (location ID, product ID) and the quantity of the
+        cart lines of assigned shipments, of all the lines or only the ones
+        of line_ids or shipment_ids
+        '''
+        pool = Pool()
+        CartLine = pool.get('stock.shipment.out.cart.line')
+        Shipment = pool.get('stock.shipment.out')
+        line = CartLine.__table__()
+        shipment = Shipment.__table__()
+        cursor = Transaction().connection.cursor()
+
+        if line_ids is not None:
+            column, ids = line.id, line_ids
+        elif shipment_ids is not None:
+            column, ids = line.shipment, shipment_ids
+        else:
+            column, ids = None, [None]
+
+        quantities = {}
+        for sub_ids in grouped_slice(ids):
+            where = shipment.state == 'assigned'
+            if column is not None:
+                where &= reduce_ids(column, list(sub_ids))
+            cursor.execute(*line.join(shipment,
+                    condition=line.shipment == shipment.id
+                    ).select(line.from_location, line.product,
+                    Sum(line.quantity),
+                    where=where,
+                    group_by=[line.from_location, line.product]))
+            for location_id, product_id, quantity in cursor.fetchall():
+                key = (location_id, product_id)
+                quantities[key] = quantities.get(key, 0) + quantity
+        return quantities
+
+    @classmethod
+    def update_quantities(cls, old, new):
+        '''
+        Add the difference between the new and old quantities, dicts with
+        (location ID, product ID) and quantity, to the picking quantities
+        '''
+        transaction = Transaction()
+
+        # Sorted keys lock the rows always in the same order
+        deltas = []
+        for key in sorted(set(old) | set(new)):
+            delta = new.get(key, 0) - old.get(key, 0)
+            if delta:
+                deltas.append(key + (delta,))
+        if not deltas:
+            return
+        # ON CONFLICT is supported since PostgreSQL 9.5
+        if (backend.name() == 'postgresql'
+                and transaction.database.get_version(
+                    transaction.connection) >= (9, 5)):
+            cls._upsert_quantities(deltas)
+        else:
+            for location_id, product_id, delta in deltas:
+                cls._add_quantity(location_id, product_id, delta)
+
+    @classmethod
+    def _upsert_quantities(cls, deltas):
+        'Add the (location ID, product ID, delta) deltas in one query'
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        # python-sql has no ON CONFLICT clause
+        cursor.execute('INSERT INTO "%(table)s" '
+            '(location, product, quantity, create_uid, create_date) '
+            'VALUES %(values)s '
+            'ON CONFLICT (location, product) DO UPDATE '
+            'SET quantity = "%(table)s".quantity + EXCLUDED.quantity, '
+            'write_uid = EXCLUDED.create_uid, '
+            'write_date = EXCLUDED.create_date' % {
+                'table': cls._table,
+                'values': ', '.join(
+                    ['(%s, %s, %s, %s, CURRENT_TIMESTAMP)'] * len(deltas)),
+                },
+            list(chain.from_iterable((location_id, product_id, delta,
+                        transaction.user)
+                    for location_id, product_id, delta in deltas)))
+
+    @classmethod
+    def _add_quantity(cls, location_id, product_id, delta):
+        '''
+        Add delta to the picking quantity of the location and product,
+        inserting it if it does not exist yet, in a savepoint on PostgreSQL
+        '''
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        update = table.update([table.quantity], [table.quantity + delta],
+            where=(table.location == location_id)
+            & (table.product == product_id))
+        cursor.execute(*update)
+        if cursor.rowcount:
+            return
+        # Rows are kept at zero, so they are inserted only once
+        insert = table.insert([table.location, table.product,
+                table.quantity, table.create_uid, table.create_date],
+            [[location_id, product_id, delta, transaction.user,
+                    CurrentTimestamp()]])
+        if backend.name() != 'postgresql':
+            # SQLite writes are serialized by the database lock
+            cursor.execute(*insert)
+            return
+        cursor.execute('SAVEPOINT stock_cart_picking_quantity')
+        try:
+            cursor.execute(*insert)
+        except DatabaseIntegrityError:
+            # Inserted by a concurrent transaction
+            cursor.execute('ROLLBACK TO SAVEPOINT stock_cart_picking_quantity')
+            cursor.execute(*update)
+            if not cursor.rowcount:
+                # Not visible in the snapshot, the request is retried
+                raise DatabaseOperationalError(
+                    'Picking quantity inserted concurrently')
+        else:
+            cursor.execute('RELEASE SAVEPOINT stock_cart_picking_quantity')
+
+    @classmethod
+    def get_quantities(cls, locations, products=None):
+        '''
+        Return a dict with (location ID, product ID) and picking quantity
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        where = (reduce_ids(table.location, [l.id for l in locations])
+            & (table.quantity != 0))
+        if products is not None:
+            where &= reduce_ids(table.product, [p.id for p in products])
+        cursor.execute(*table.select(table.location, table.product,
+                table.quantity, where=where))
+        return dict(((location_id, product_id), quantity)
+            for location_id, product_id, quantity in cursor.fetchall())
+
+    @classmethod
+    def check(cls):
+        '''
+        Return the differences between the picking quantities and the cart
+        lines: a list of (location ID, product ID, quantity, line quantity)
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.select(table.location, table.product,
+                table.quantity))
+        quantities = dict(((location_id, product_id), quantity)
+            for location_id, product_id, quantity in cursor.fetchall())
+        line_quantities = cls.get_line_quantities()
+        differences = []
+        for key in sorted(set(quantities) | set(line_quantities)):
+            quantity = quantities.get(key, 0)
+            line_quantity = line_quantities.get(key, 0)
+            # Float sums may differ in the last digits
+            if round(quantity - line_quantity, 6):
+                differences.append(key + (quantity, line_quantity))
+        return differences
+
+    @classmethod
+    def rebuild(cls):
+        'Compute again all the picking quantities from the cart lines'
+        pool = Pool()
+        CartLine = pool.get('stock.shipment.out.cart.line')
+        Shipment = pool.get('stock.shipment.out')
+        table = cls.__table__()
+        line = CartLine.__table__()
+        shipment = Shipment.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        cursor.execute(*table.delete())
+        cursor.execute(*table.insert([table.location, table.product,
+                    table.quantity, table.create_uid, table.create_date],
+                line.join(shipment,
+                    condition=line.shipment == shipment.id
+                    ).select(line.from_location, line.product,
+                    Sum(line.quantity), Literal(transaction.user),
+                    CurrentTimestamp(),
+                    where=shipment.state == 'assigned',
+                    group_by=[line.from_location, line.product])))
+
+    @classmethod
+    def check_quantities(cls):
+        'Rebuild the picking quantities if they differ from the lines - Cron'
+        differences = cls.check()
+        if differences:
+            logger.warning('Picking quantities differ from the cart lines, '
+                'they are rebuilt: %s' % differences)
+            cls.rebuild()
+
+
+class StockShipmentOutCartReservation(ModelSQL):
+    'Stock Shipment Out Cart Reservation'
+    __name__ = 'stock.shipment.out.cart.reservation'
+    user = fields.Many2One('res.user', 'User', required=True, select=True,
+        ondelete='CASCADE')
+    protocol = fields.Integer('Protocol', required=True)
+    pick_list = fields.Text('Pick List')
+    date = fields.DateTime('Date')
+
+    @classmethod
+    def __setup__(cls):
+        super(StockShipmentOutCartReservation, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('user_uniq', Unique(t, t.user),
+                'The user must be unique!'),
+            ]
+
+    @staticmethod
+    def default_protocol():
+        return 1
+
+    def dump_pick_list(self, products):
+        'Set the pick list of get_products_by_carts'
+        self.pick_list = json.dumps(products, cls=JSONEncoder,
+            separators=(',', ':'))
+
+    def load_pick_list(self):
+        'Return the pick list of get_products_by_carts'
+        products = json.loads(self.pick_list, object_hook=JSONDecoder())
+        if self.protocol < 3:
+            # JSON keys are strings but products are keyed by ID
+            products = [dict((int(k), v) for k, v in p.iteritems())
+                for p in products]
+        return products
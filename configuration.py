@@ -2,6 +2,7 @@
 # copyright notices and license terms.
 from trytond.model import fields
 from trytond.pool import PoolMeta
+from trytond.pyson import Eval, Equal, Not
 
 __all__ = ['Configuration']
 
@@ -10,7 +11,92 @@ class Configuration:
     __name__ = 'stock.configuration'
     __metaclass__ = PoolMeta
     stock_cart_create_issue = fields.Boolean('Create Issue')
+    stock_cart_claim_method = fields.Selection([
+            ('table', 'Table Lock'),
+            ('row', 'Row Lock'),
+            ], 'Cart Claim Method', required=True,
+        help='Table Lock: only one user can get new shipments at a time.\n'
+        'Row Lock: users get different shipments at the same time. It '
+        'requires PostgreSQL 9.5 or later, otherwise Table Lock is used.')
+    stock_cart_lock_timeout = fields.Integer('Cart Lock Timeout',
+        help='Milliseconds the database waits for the carts table lock on '
+        'each attempt (PostgreSQL only). Zero does not wait.')
+    stock_cart_lock_max_wait = fields.Integer('Cart Lock Maximum Wait',
+        help='Maximum milliseconds to get the carts table lock retrying it. '
+        'After that, no shipments are returned.')
+    stock_cart_route = fields.Selection([
+            ('sequence', 'Location Sequence'),
+            ('nearest', 'Nearest Location'),
+            ('s_shape', 'S-Shape'),
+            ], 'Cart Pick Route', required=True,
+        help='Order of the cart pick list.\n'
+        'Location Sequence: sequence of the locations.\n'
+        'Nearest Location: route to the nearest location improved with '
+        '2-opt by the pick X and Y of the locations.\n'
+        'S-Shape: aisles by pick X in order, alternating the direction on '
+        'each aisle.\n'
+        'Locations without pick X and Y are picked last by sequence.')
+    stock_cart_route_time = fields.Integer('Cart Pick Route Time',
+        help='Maximum milliseconds to improve the Nearest Location route.')
+    stock_cart_assignment = fields.Selection([
+            ('priority', 'Priority'),
+            ('batch', 'Order Batching'),
+            ], 'Cart Assignment', required=True,
+        help='Shipments to fill the carts.\n'
+        'Priority: the first ones by carrier, planned date and create date.\n'
+        'Order Batching: the first one and the ones that share more '
+        'locations and products with it.')
+    stock_cart_batch_window = fields.Integer('Cart Batch Window',
+        help='Days after the planned date of the first shipment that the '
+        'shipments can be batched with it.',
+        states={
+            'invisible': Not(Equal(Eval('stock_cart_assignment'), 'batch')),
+            },
+        depends=['stock_cart_assignment'])
+    stock_cart_reservation_time = fields.Integer('Cart Reservation Time',
+        help='Minutes that the next cart prepared for a user is reserved. '
+        'After that, its shipments can be assigned to other carts.')
+    stock_cart_lease_time = fields.Integer('Cart Lease Time',
+        help='Minutes without activity of the user after which the shipments '
+        'of its draft carts without pickings can be assigned to other carts. '
+        'Zero never expires.')
 
     @staticmethod
     def default_stock_cart_create_issue():
         return False
+
+    @staticmethod
+    def default_stock_cart_claim_method():
+        return 'table'
+
+    @staticmethod
+    def default_stock_cart_lock_timeout():
+        return 500
+
+    @staticmethod
+    def default_stock_cart_lock_max_wait():
+        return 2000
+
+    @staticmethod
+    def default_stock_cart_route():
+        return 'sequence'
+
+    @staticmethod
+    def default_stock_cart_route_time():
+        return 100
+
+    @staticmethod
+    def default_stock_cart_assignment():
+        return 'priority'
+
+    @staticmethod
+    def default_stock_cart_batch_window():
+        return 1
+
+    @staticmethod
+    def default_stock_cart_reservation_time():
+        return 15
+
+    @staticmethod
+    def default_stock_cart_lease_time():
+        return 0
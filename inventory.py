@@ -13,24 +13,26 @@ class Inventory:
     __metaclass__ = PoolMeta
     __name__ = 'stock.inventory'
 
-    @classmethod
-    def confirm(cls, inventories):
-        # Confirm an inventory do a write and write call again complete_lines
-        # We add confirm in the context to not skip to calculate get_picking_quantity
-        with Transaction().set_context(confirm_inventory=True):
-            super(Inventory, cls).confirm(inventories)
-
     @classmethod
     def complete_lines(cls, inventories, fill=True):
-        # can't call Line.create_values4complete() because we don't have the product.
-        # At the moment, to add new values is call complete_lines (yes, other write)
-        super(Inventory, cls).complete_lines(inventories, fill)
-
-        if Transaction().context.get('confirm_inventory', False):
-            return
-
-        if fill:
-            cls.complete_lines(inventories, fill=False)
+        pool = Pool()
+        Line = pool.get('stock.inventory.line')
+
+        # Picking quantities of all lines are computed once and added to the
+        # values of the lines created or updated by the completion
+        quantities = Line.get_picking_quantities(
+            [i.location for i in inventories])
+        location2inventories = {}
+        for inventory in inventories:
+            location2inventories.setdefault(inventory.location.id, []).append(
+                inventory.id)
+        picking_quantities = {}
+        for (location_id, product_id), quantity in quantities.iteritems():
+            for inventory_id in location2inventories[location_id]:
+                picking_quantities[(inventory_id, product_id)] = quantity
+        with Transaction().set_context(
+                stock_cart_picking_quantities=picking_quantities):
+            super(Inventory, cls).complete_lines(inventories, fill)
 
 
 class InventoryLine:
@@ -43,25 +45,23 @@ class InventoryLine:
     def default_picking_quantity():
         return 0
 
+    @classmethod
+    def get_picking_quantities(cls, locations, products=None):
+        """
+        Return a dict with (location ID, product ID) and picking quantity
+        """
+        PickingQuantity = Pool().get(
+            'stock.shipment.out.cart.picking_quantity')
+        return PickingQuantity.get_quantities(locations, products)
+
     @classmethod
     def get_picking_quantity(cls, location, products):
         """"
         Return a dict with product ID and picking quantity
         """
-        CartLine = Pool().get('stock.shipment.out.cart.line')
-
-        vals = {}
-        for line in CartLine.search([
-                ('product', 'in', products),
-                ('from_location', '=', location),
-                ('shipment.state', '=', 'assigned')
-                ]):
-            product_id = line.product.id
-            if product_id in vals:
-                vals[product_id] += line.quantity
-            else:
-                vals[product_id] = line.quantity
-        return vals
+        quantities = cls.get_picking_quantities([location], products)
+        return dict((product_id, quantity)
+            for (_, product_id), quantity in quantities.iteritems())
 
     @fields.depends('product', 'inventory')
     def on_change_product(self):
@@ -81,10 +81,39 @@ class InventoryLine:
         Return update values to complete inventory
         '''
         values = super(InventoryLine, self).update_values4complete(quantity)
-        picking_quantity = self.get_picking_quantity(self.inventory.location,
-            [self.product]).get(self.product.id, 0)
-        if (self.expected_quantity == self.quantity == quantity and
+        quantities = Transaction().context.get('stock_cart_picking_quantities')
+        if quantities is not None:
+            picking_quantity = quantities.get(
+                (self.inventory.id, self.product.id), 0)
+        else:
+            picking_quantity = self.get_picking_quantity(
+                self.inventory.location, [self.product]).get(
+                self.product.id, 0)
+        # Compare with the values once updated, so a changed expected
+        # quantity is adjusted in the same completion
+        expected_quantity = values.get('expected_quantity',
+            self.expected_quantity)
+        line_quantity = values.get('quantity', self.quantity)
+        if (expected_quantity == line_quantity == quantity and
                 self.picking_quantity != picking_quantity):
             values['picking_quantity'] = picking_quantity
             values['quantity'] = max(quantity - picking_quantity, 0.0)
         return values
+
+    @classmethod
+    def create(cls, vlist):
+        # Lines created by complete_lines
+        quantities = Transaction().context.get('stock_cart_picking_quantities')
+        if quantities:
+            vlist = [v.copy() for v in vlist]
+            for values in vlist:
+                picking_quantity = quantities.get(
+                    (values.get('inventory'), values.get('product')), 0)
+                quantity = values.get('quantity')
+                if (quantity is not None
+                        and values.get('expected_quantity') == quantity
+                        and values.get('picking_quantity', 0)
+                        != picking_quantity):
+                    values['picking_quantity'] = picking_quantity
+                    values['quantity'] = max(quantity - picking_quantity, 0.0)
+        return super(InventoryLine, cls).create(vlist)
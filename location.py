@@ -0,0 +1,42 @@
+# This file is part of stock_cart module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.model import fields
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['Location']
+
+
+class Location:
+    __metaclass__ = PoolMeta
+    __name__ = 'stock.location'
+    pick_x = fields.Float('Pick X',
+        help='Position of the aisle of the location, used to sort the cart '
+        'pick list by route.')
+    pick_y = fields.Float('Pick Y',
+        help='Position of the location along its aisle, used to sort the '
+        'cart pick list by route.')
+    pick_level = fields.Integer('Pick Level',
+        help='Level of the location in its position. Lower levels are '
+        'picked first.')
+
+    @staticmethod
+    def _clear_cart_cache():
+        Cart = Pool().get('stock.shipment.out.cart')
+        Cart._locations_cache.clear()
+
+    @classmethod
+    def create(cls, vlist):
+        locations = super(Location, cls).create(vlist)
+        cls._clear_cart_cache()
+        return locations
+
+    @classmethod
+    def write(cls, *args):
+        super(Location, cls).write(*args)
+        cls._clear_cart_cache()
+
+    @classmethod
+    def delete(cls, locations):
+        super(Location, cls).delete(locations)
+        cls._clear_cart_cache()
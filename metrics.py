@@ -0,0 +1,225 @@
+# This file is part of stock_cart module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+import logging
+import threading
+from functools import wraps
+from time import time
+
+from trytond.config import config
+from trytond.transaction import Transaction
+
+__all__ = ['Counters', 'lock_counters', 'profile', 'profiled', 'phase',
+    'add_value', 'register_sink', 'unregister_sink']
+
+logger = logging.getLogger(__name__)
+
+
+class Counters(object):
+    'Thread safe counters of the server process'
+
+    def __init__(self, *names):
+        self._lock = threading.Lock()
+        self._names = names
+        self._values = dict.fromkeys(names, 0)
+
+    def add(self, name, value=1):
+        with self._lock:
+            self._values[name] += value
+
+    def values(self):
+        with self._lock:
+            return self._values.copy()
+
+    def reset(self):
+        with self._lock:
+            self._values = dict.fromkeys(self._names, 0)
+
+# Contention on the carts table lock:
+# attempts: lock requests, conflicts: lock requests that failed,
+# wait_time: seconds waiting the lock, give_ups: requests without lock
+lock_counters = Counters('attempts', 'conflicts', 'wait_time', 'give_ups')
+
+
+class CountingCursor(object):
+    'Cursor wrapper that counts the executed queries'
+
+    def __init__(self, cursor, counter):
+        self._cursor = cursor
+        self._counter = counter
+
+    def execute(self, *args, **kwargs):
+        self._counter.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+
+class CountingConnection(object):
+    'Connection wrapper that returns counting cursors'
+
+    def __init__(self, connection, counter):
+        self._connection = connection
+        self._counter = counter
+
+    def cursor(self, *args, **kwargs):
+        return CountingCursor(self._connection.cursor(*args, **kwargs),
+            self._counter)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+# Callables that receive the profile dictionary of each RPC
+_sinks = []
+_local = threading.local()
+
+
+def register_sink(sink):
+    'Send the profiles of the RPCs to sink, a callable of one dictionary'
+    if sink not in _sinks:
+        _sinks.append(sink)
+
+
+def unregister_sink(sink):
+    if sink in _sinks:
+        _sinks.remove(sink)
+
+
+def _config_sink():
+    'Return the sink of the profile_sink option: "module:callable"'
+    path = config.get('stock_cart', 'profile_sink', default='')
+    if not path:
+        return None
+    module, name = path.split(':')
+    return getattr(__import__(module, fromlist=[name]), name)
+
+
+class _Nothing(object):
+    'Context manager that does nothing'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+_nothing = _Nothing()
+
+
+class Profile(object):
+    '''
+    Profile of an RPC: duration, SQL queries and per phase duration and
+    queries, plus values like lock wait seconds or rows handled
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.phases = []
+        self.values = {}
+
+    def __enter__(self):
+        transaction = Transaction()
+        self._connection = transaction.connection
+        transaction.connection = CountingConnection(self._connection, self)
+        _local.profile = self
+        self._start = time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        duration = time() - self._start
+        _local.profile = None
+        transaction = Transaction()
+        transaction.connection = self._connection
+        result = {
+            'rpc': self.name,
+            'user': transaction.user,
+            'duration': duration,
+            'queries': self.queries,
+            'phases': [{
+                    'name': n,
+                    'duration': d,
+                    'queries': q,
+                    } for n, d, q in self.phases],
+            'values': self.values,
+            'error': type.__name__ if type else None,
+            }
+        logger.info('%s: %.3f s, %d queries, %s, %s', self.name, duration,
+            self.queries, ', '.join('%s %.3f s %d queries' % p
+                for p in self.phases),
+            ', '.join('%s %s' % v for v in sorted(self.values.iteritems())))
+        sinks = list(_sinks)
+        sink = _config_sink()
+        if sink and sink not in sinks:
+            sinks.append(sink)
+        for sink in sinks:
+            try:
+                sink(result)
+            except Exception:
+                logger.exception('Profile sink %s failed', sink)
+
+
+class Phase(object):
+    'Phase of the current profile'
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self._queries = self.profile.queries
+        self._start = time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.profile.phases.append((self.name, time() - self._start,
+                self.profile.queries - self._queries))
+
+
+def _current():
+    return getattr(_local, 'profile', None)
+
+
+def profile(name):
+    '''
+    Return the context manager that profiles the RPC name if the profile
+    option of the stock_cart section of the configuration file is set.
+    Inside another profile, it is a phase of it.
+    '''
+    current = _current()
+    if current is not None:
+        return Phase(current, name)
+    if not config.getboolean('stock_cart', 'profile', default=False):
+        return _nothing
+    return Profile(name)
+
+
+def profiled(name):
+    'Decorator that profiles the calls of the function as name'
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def phase(name):
+    'Return the context manager of the phase name of the current profile'
+    current = _current()
+    if current is None:
+        return _nothing
+    return Phase(current, name)
+
+
+def add_value(name, value):
+    'Add value to the value name of the current profile'
+    current = _current()
+    if current is not None:
+        current.values[name] = current.values.get(name, 0) + value
@@ -0,0 +1,106 @@
+# This file is part of stock_cart module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+'''
+Pick route heuristics on location coordinates.
+
+Points are (x, y) tuples where x is the position of the aisle and y the
+position along the aisle. Routes start and end at the depot and distances
+are rectilinear.
+'''
+from time import time
+
+__all__ = ['distance', 'route_length', 'nearest_neighbour', 'two_opt',
+    's_shape', 'optimize_route']
+
+DEPOT = (0, 0)
+
+
+def distance(a, b):
+    return abs(a[0] - b[0]) + abs(a[1] - b[1])
+
+
+def route_length(points, route, start=DEPOT):
+    'Return the length of visiting points in route order from start'
+    length = 0
+    current = start
+    for index in route:
+        length += distance(current, points[index])
+        current = points[index]
+    return length + distance(current, start)
+
+
+def nearest_neighbour(points, start=DEPOT):
+    'Return the route that always visits the closest pending point'
+    pending = set(range(len(points)))
+    route = []
+    current = start
+    while pending:
+        index = min(pending,
+            key=lambda i: (distance(current, points[i]), points[i], i))
+        pending.remove(index)
+        route.append(index)
+        current = points[index]
+    return route
+
+
+def two_opt(points, route, start=DEPOT, deadline=None, passes=None):
+    '''
+    Return route improved reversing the segments that make it shorter until
+    no segment does, deadline (time) is reached or after passes over all the
+    segments
+    '''
+    path = [start] + [points[i] for i in route] + [start]
+    tour = [None] + list(route) + [None]
+    improved = True
+    while improved:
+        if passes is not None:
+            if passes <= 0:
+                break
+            passes -= 1
+        improved = False
+        for i in range(1, len(path) - 2):
+            if deadline is not None and time() > deadline:
+                return tour[1:-1]
+            for j in range(i + 1, len(path) - 1):
+                delta = (distance(path[i - 1], path[j])
+                    + distance(path[i], path[j + 1])
+                    - distance(path[i - 1], path[i])
+                    - distance(path[j], path[j + 1]))
+                if delta < 0:
+                    path[i:j + 1] = reversed(path[i:j + 1])
+                    tour[i:j + 1] = reversed(tour[i:j + 1])
+                    improved = True
+    return tour[1:-1]
+
+
+def s_shape(points, start=DEPOT):
+    '''
+    Return the route that traverses the aisles in order, alternating the
+    direction on each aisle
+    '''
+    aisles = {}
+    for index, point in enumerate(points):
+        aisles.setdefault(point[0], []).append(index)
+    route = []
+    xs = sorted(aisles, key=lambda x: abs(x - start[0]))
+    for number, x in enumerate(xs):
+        route.extend(sorted(aisles[x], key=lambda i: points[i][1],
+                reverse=bool(number % 2)))
+    return route
+
+
+def optimize_route(points, method='nearest', time_budget=0.1, start=DEPOT,
+        passes=None):
+    '''
+    Return the order to visit points with method:
+        nearest: nearest neighbour improved with 2-opt for time_budget
+            seconds or, if passes is set, for that number of 2-opt passes
+            so the route is always the same
+        s_shape: S-shape traversal of the aisles
+    '''
+    if method == 's_shape':
+        return s_shape(points, start)
+    deadline = time() + time_budget if passes is None else None
+    route = nearest_neighbour(points, start)
+    return two_opt(points, route, start, deadline, passes)
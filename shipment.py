@@ -0,0 +1,32 @@
+# This file is part of stock_cart module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+from trytond.pool import Pool, PoolMeta
+
+__all__ = ['ShipmentOut']
+
+
+class ShipmentOut:
+    __metaclass__ = PoolMeta
+    __name__ = 'stock.shipment.out'
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        PickingQuantity = pool.get('stock.shipment.out.cart.picking_quantity')
+
+        # Cart lines are picking quantities only while shipments are assigned
+        shipment_ids = set()
+        actions = iter(args)
+        for shipments, values in zip(actions, actions):
+            if 'state' in values:
+                shipment_ids.update(s.id for s in shipments)
+        shipment_ids = list(shipment_ids)
+        if shipment_ids:
+            old = PickingQuantity.get_line_quantities(
+                shipment_ids=shipment_ids)
+        super(ShipmentOut, cls).write(*args)
+        if shipment_ids:
+            PickingQuantity.update_quantities(old,
+                PickingQuantity.get_line_quantities(
+                    shipment_ids=shipment_ids))
@@ -0,0 +1,765 @@
+# This file is part of the stock_cart module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of stock_cart operations.
+
+It uses the database of the trytond tests (DB_NAME and TRYTOND_DATABASE_URI
+environment variables) and prints the time, SQL queries and memory growth and
+peak resident memory of each operation on a synthetic warehouse:
+
+    DB_NAME=:memory: python -m trytond.modules.stock_cart.tests.benchmark_stock_cart
+
+or on PostgreSQL:
+
+    TRYTOND_DATABASE_URI=postgresql:// DB_NAME=test \
+        python -m trytond.modules.stock_cart.tests.benchmark_stock_cart \
+        --locations 2000 --products 5000 --shipments 1000
+
+Save the results of a revision with --output and compare other revisions
+with them with --compare:
+
+    ... benchmark_stock_cart --output before.json
+    ... benchmark_stock_cart --compare before.json
+
+The indexes benchmark prints the plans of the hot queries with and without
+the indexes of the module:
+
+    ... benchmark_stock_cart indexes --shipments 5000
+
+The pick routes, order batching and payload benchmarks do not need a
+database:
+
+    python -m trytond.modules.stock_cart.tests.benchmark_stock_cart route \
+        batch payload
+'''
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import threading
+from decimal import Decimal
+from time import time
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from sql.aggregate import Sum
+
+from trytond import backend
+from trytond.tests.test_tryton import install_module, DB_NAME, USER, CONTEXT
+from trytond.pool import Pool
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.stock_cart.metrics import CountingConnection
+from trytond.modules.stock_cart.route import (route_length,
+    nearest_neighbour, two_opt, s_shape)
+from trytond.modules.stock_cart.batching import batch_orders
+from trytond.modules.stock_cart.cart import (group_by_product,
+    compact_by_product)
+from trytond.modules.stock_cart.tests.test_stock_cart import (
+    synthetic_cart_moves)
+
+# Seconds between the samples of the resident memory of an operation
+RSS_INTERVAL = 0.005
+
+
+def current_rss():
+    'Return the resident memory of the process in KiB or None if unknown'
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss():
+    'Return the peak resident memory of the process in KiB'
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class RSSSampler(threading.Thread):
+    'Sample the resident memory of the process until it is stopped'
+    daemon = True
+
+    def __init__(self):
+        super(RSSSampler, self).__init__()
+        self.start_rss = self.peak = current_rss()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(RSS_INTERVAL):
+            self.sample()
+
+    def sample(self):
+        rss = current_rss()
+        if rss is not None:
+            self.peak = max(self.peak, rss)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+        self.sample()
+
+
+class Measure(object):
+    '''
+    Measure the time, SQL queries and memory in KiB of the current
+    transaction.
+    Memory is the growth of the resident memory of the process sampled during
+    the operation, so memory freed by previous operations and reused is not
+    counted, and rss is its peak. Without /proc, memory is the growth of the
+    peak resident memory of the process and rss is that peak.
+    '''
+    results = []
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.duration = 0
+        self.memory = 0
+        self.rss = 0
+
+    def __enter__(self):
+        transaction = Transaction()
+        self._connection = transaction.connection
+        transaction.connection = CountingConnection(self._connection, self)
+        self._sampler = RSSSampler()
+        if self._sampler.start_rss is not None:
+            self._sampler.start()
+        else:
+            self._sampler = None
+            self._rss = max_rss()
+        self._start = time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.duration = time() - self._start
+        if self._sampler is not None:
+            self._sampler.stop()
+            self.rss = self._sampler.peak
+            self.memory = self.rss - self._sampler.start_rss
+        else:
+            self.rss = max_rss()
+            self.memory = self.rss - self._rss
+        Transaction().connection = self._connection
+        Measure.results.append(self)
+
+    def __str__(self):
+        return '%-40s %10.3f s %8d queries %10d KiB %10d KiB RSS' % (
+            self.name, self.duration, self.queries, self.memory, self.rss)
+
+    def to_dict(self):
+        return {
+            'duration': self.duration,
+            'queries': self.queries,
+            'memory': self.memory,
+            'rss': self.rss,
+            }
+
+
+def create_products(count, uom):
+    'Create count goods products'
+    pool = Pool()
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+
+    templates = Template.create([{
+                'name': 'Product %s' % i,
+                'type': 'goods',
+                'list_price': Decimal(1),
+                'cost_price': Decimal(0),
+                'cost_price_method': 'fixed',
+                'default_uom': uom.id,
+                } for i in range(count)])
+    return Product.create([{
+                'template': t.id,
+                'code': 'PROD%s' % i,
+                } for i, t in enumerate(templates)])
+
+
+def fill_stock(products, locations, quantity, company):
+    'Receive quantity of each product in each location'
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Move = pool.get('stock.move')
+
+    supplier, = Location.search([('code', '=', 'SUP')])
+    today = datetime.date.today()
+    moves = Move.create([{
+                'product': p.id,
+                'uom': p.default_uom.id,
+                'quantity': quantity,
+                'from_location': supplier.id,
+                'to_location': l.id,
+                'planned_date': today,
+                'effective_date': today,
+                'company': company.id,
+                'unit_price': Decimal(1),
+                'currency': company.currency.id,
+                } for p in products for l in locations])
+    Move.do(moves)
+
+
+def create_location_tree(parent, aisles, positions, levels):
+    '''
+    Create aisles storage locations under parent with positions children each
+    with levels children each and return the levels locations.
+    Locations have the pick coordinates of aisles 3 meters apart with
+    positions each meter and the sequence of the location path.
+    '''
+    Location = Pool().get('stock.location')
+
+    aisles = Location.create([{
+                'name': 'A%02d' % a,
+                'code': 'A%02d' % a,
+                'type': 'storage',
+                'parent': parent.id,
+                'sequence': a,
+                } for a in range(aisles)])
+    slots = Location.create([{
+                'name': '%s-%03d' % (aisle.name, p),
+                'code': '%s-%03d' % (aisle.name, p),
+                'type': 'storage',
+                'parent': aisle.id,
+                'sequence': p,
+                } for aisle in aisles for p in range(positions)])
+    return Location.create([{
+                'name': '%s-%d' % (slot.name, l),
+                'code': '%s-%d' % (slot.name, l),
+                'type': 'storage',
+                'parent': slot.id,
+                'sequence': (a * positions + p) * levels + l,
+                'pick_x': a * 3,
+                'pick_y': p + 1,
+                'pick_level': l,
+                } for a, aisle in enumerate(aisles)
+            for p, slot in enumerate(slots[a * positions:(a + 1) * positions])
+            for l in range(levels)])
+
+
+def fill_slots(slots, quantity, company):
+    'Receive quantity of each (product, location) of slots'
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Move = pool.get('stock.move')
+
+    supplier, = Location.search([('code', '=', 'SUP')])
+    today = datetime.date.today()
+    moves = Move.create([{
+                'product': p.id,
+                'uom': p.default_uom.id,
+                'quantity': quantity,
+                'from_location': supplier.id,
+                'to_location': l.id,
+                'planned_date': today,
+                'effective_date': today,
+                'company': company.id,
+                'unit_price': Decimal(1),
+                'currency': company.currency.id,
+                } for p, l in slots])
+    Move.do(moves)
+
+
+def shipment_lines(count, mean, maximum, seed=0):
+    '''
+    Return the lines of count shipments with a geometric distribution of
+    mean lines, as most orders have few lines
+    '''
+    rng = random.Random(seed)
+    return [min(int(rng.expovariate(1. / mean)) + 1, maximum)
+        for _ in range(count)]
+
+
+def create_shipments(count, products, lines, company, rng=None):
+    '''
+    Create count assigned shipments of lines products each, lines is the
+    number of lines of all the shipments or a list with the lines of each
+    shipment. With the random generator rng, products are chosen at random,
+    a fifth of them in most shipments, otherwise they are consecutive.
+    '''
+    pool = Pool()
+    Party = pool.get('party.party')
+    Location = pool.get('stock.location')
+    Shipment = pool.get('stock.shipment.out')
+
+    customer, = Party.create([{
+                'name': 'Customer',
+                'addresses': [('create', [{}])],
+                }])
+    warehouse, = Location.search([('code', '=', 'WH')])
+    today = datetime.date.today()
+    if isinstance(lines, int):
+        lines = [lines] * count
+
+    def shipment_products(i):
+        if rng is None:
+            return [products[(i + j) % len(products)]
+                for j in range(lines[i])]
+        popular = products[:max(len(products) // 5, lines[i])]
+        return rng.sample(popular if rng.random() < 0.8 else products,
+            lines[i])
+
+    shipments = Shipment.create([{
+                'planned_date': today,
+                'customer': customer.id,
+                'delivery_address': customer.addresses[0].id,
+                'warehouse': warehouse.id,
+                'company': company.id,
+                'outgoing_moves': [('create', [{
+                                'product': p.id,
+                                'uom': p.default_uom.id,
+                                'quantity': 1,
+                                'from_location': warehouse.output_location.id,
+                                'to_location': customer.customer_location.id,
+                                'company': company.id,
+                                'unit_price': Decimal(1),
+                                'currency': company.currency.id,
+                                } for p in shipment_products(i)])],
+                } for i in range(count)])
+    Shipment.wait(shipments)
+    Shipment.assign_try(shipments)
+    return shipments
+
+
+def pick_shipments(shipments, cart):
+    'Create cart lines of all the inventory moves of shipments'
+    CartLine = Pool().get('stock.shipment.out.cart.line')
+
+    CartLine.create([{
+                'shipment': s.id,
+                'from_location': m.from_location.id,
+                'cart': cart.id,
+                'product': m.product.id,
+                'uom': m.uom.id,
+                'quantity': m.quantity,
+                } for s in shipments for m in s.inventory_moves])
+
+
+def benchmark_inventory(products=1000, shipments=100, lines=5):
+    'Complete an inventory with picking quantities'
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    Location = pool.get('stock.location')
+    Cart = pool.get('stock.cart')
+    Inventory = pool.get('stock.inventory')
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    storage, = Location.search([('code', '=', 'STO')])
+    company = create_company()
+    with set_company(company):
+        products = create_products(products, unit)
+        fill_stock(products, [storage], 10, company)
+        shipments = create_shipments(shipments, products, lines, company)
+        cart, = Cart.create([{'name': 'Benchmark'}])
+        pick_shipments(shipments, cart)
+
+        inventory, = Inventory.create([{
+                    'location': storage.id,
+                    'company': company.id,
+                    }])
+        with Measure('Inventory.complete_lines (create)') as measure:
+            Inventory.complete_lines([inventory])
+        print(measure)
+        with Measure('Inventory.complete_lines (update)') as measure:
+            Inventory.complete_lines([inventory])
+        print(measure)
+        with Measure('Inventory.confirm') as measure:
+            Inventory.confirm([inventory])
+        print(measure)
+
+
+def warehouse_layout(aisles, positions, picks, seed=0):
+    '''
+    Return picks random locations of a warehouse with aisles of positions
+    each, 3 meters between aisles and 1 meter between positions
+    '''
+    rng = random.Random(seed)
+    return [(rng.randrange(aisles) * 3, rng.randrange(positions) + 1)
+        for _ in range(picks)]
+
+
+def benchmark_route(seeds=5):
+    'Compare the pick routes of synthetic warehouse layouts'
+    methods = [
+        ('Location sequence (aisle, position)',
+            lambda points: sorted(range(len(points)),
+                key=lambda i: points[i])),
+        ('S-Shape', s_shape),
+        ('Nearest neighbour', nearest_neighbour),
+        ('Nearest neighbour + 2-opt',
+            lambda points: two_opt(points, nearest_neighbour(points))),
+        ]
+    for aisles, positions, picks in [
+            (10, 20, 20),
+            (20, 50, 80),
+            (40, 100, 200),
+            (60, 100, 500),
+            ]:
+        print('%s aisles, %s positions, %s picks' % (
+                aisles, positions, picks))
+        for name, method in methods:
+            length = duration = 0
+            for seed in range(seeds):
+                points = warehouse_layout(aisles, positions, picks, seed)
+                start = time()
+                route = method(points)
+                duration += time() - start
+                length += route_length(points, route)
+            print('    %-40s %10.1f m %10.3f s' % (
+                    name, length / seeds, duration / seeds))
+
+
+def synthetic_orders(count, lines, locations, seed=0):
+    '''
+    Return count orders of up to lines location keys each, where the first
+    locations are the most popular
+    '''
+    rng = random.Random(seed)
+    return [set(('location', int(rng.paretovariate(1)) % locations)
+            for _ in range(rng.randint(1, lines)))
+        for _ in range(count)]
+
+
+def benchmark_batch(seeds=5):
+    'Compare the locations to visit by cart with and without order batching'
+    for carts, baskets, lines, locations in [
+            (10, 8, 3, 200),
+            (10, 12, 5, 1000),
+            (20, 24, 5, 5000),
+            ]:
+        print('%s carts of %s baskets, %s lines, %s locations' % (
+                carts, baskets, lines, locations))
+        for name, batching in [
+                ('Priority', False),
+                ('Order batching', True),
+                ]:
+            stops = duration = 0
+            for seed in range(seeds):
+                orders = synthetic_orders(carts * baskets * 3, lines,
+                    locations, seed)
+                start = time()
+                for _ in range(carts):
+                    if batching:
+                        batch = batch_orders(orders, baskets)
+                    else:
+                        batch = list(range(min(baskets, len(orders))))
+                    stops += len(set().union(*(orders[i] for i in batch)))
+                    batched = set(batch)
+                    orders = [o for i, o in enumerate(orders)
+                        if i not in batched]
+                duration += time() - start
+            print('    %-40s %10.1f stops %10.3f s' % (
+                    name, stops / float(seeds * carts),
+                    duration / seeds))
+
+
+def benchmark_payload(repeat=5):
+    'Compare the build time and JSON size of the pick list formats'
+    product_info = lambda product_id: {
+        'name': 'Product %s' % product_id,
+        'code': 'P%s' % product_id,
+        }
+    for carts, lines, products, locations in [
+            (8, 5, 50, 100),
+            (24, 20, 400, 1000),
+            (60, 30, 2000, 5000),
+            ]:
+        print('%s carts, %s lines, %s products, %s locations' % (
+                carts, lines, products, locations))
+        moves = synthetic_cart_moves(carts, lines, products, locations)
+        compact_moves = [(sequence, product_id, cart_id, s['id'], s['code'],
+                None, None, int(s['location'][3:]), s['quantity'])
+            for sequence, product_id, cart_id, s in moves]
+        for name, build in [
+                ('Nested', lambda: group_by_product(
+                        [m[:3] + (dict(m[3]),) for m in moves],
+                        product_info)),
+                ('Compact', lambda: compact_by_product(compact_moves,
+                        product_info, lambda l: 'LOC%s' % l)),
+                ]:
+            start = time()
+            for _ in range(repeat):
+                size = len(json.dumps(build()))
+            print('    %-40s %10.3f s %10d bytes' % (
+                    name, (time() - start) / repeat, size))
+
+
+def create_warehouse(company, locations, products, shipments, lines, rows,
+        columns, seed=0):
+    '''
+    Create a synthetic warehouse of about locations storage locations in a
+    tree of aisles, positions and levels, products stored in one or two
+    locations, assigned shipments of a mean of lines products and a cart of
+    rows and columns for the user.
+    Return the locations, products, shipments and cart.
+    '''
+    pool = Pool()
+    Uom = pool.get('product.uom')
+    Location = pool.get('stock.location')
+    User = pool.get('res.user')
+    Cart = pool.get('stock.cart')
+
+    rng = random.Random(seed)
+    unit, = Uom.search([('name', '=', 'Unit')])
+    warehouse, = Location.search([('code', '=', 'WH')])
+    storage, = Location.search([('code', '=', 'STO')])
+    start = time()
+    aisles = max(int((locations / 80.) ** .5), 1)
+    positions = max(locations // (aisles * 4), 1)
+    locations = create_location_tree(storage, aisles, positions, 4)
+    products = create_products(products, unit)
+    slots = [(p, rng.choice(locations)) for p in products]
+    slots += [(p, rng.choice(locations)) for p in rng.sample(products,
+            len(products) // 4)]
+    fill_slots(slots, 1000, company)
+    shipments = create_shipments(shipments, products,
+        shipment_lines(shipments, lines, min(len(products), 50), seed),
+        company, rng)
+    cart, = Cart.create([{
+                'name': 'Benchmark',
+                'rows': rows,
+                'columns': columns,
+                }])
+    User.write([User(Transaction().user)], {
+            'cart': cart.id,
+            'stock_warehouse': warehouse.id,
+            })
+    print('%s locations, %s products, %s shipments created in %.1f s' % (
+            len(locations), len(products), len(shipments), time() - start))
+    return locations, products, shipments, cart
+
+
+def benchmark_warehouse(locations=1000, products=2000, shipments=500,
+        lines=3, rows=4, columns=6, seed=0):
+    'Run the cart operations on a synthetic warehouse'
+    pool = Pool()
+    Location = pool.get('stock.location')
+    ShipmentCart = pool.get('stock.shipment.out.cart')
+    ShipmentCartLine = pool.get('stock.shipment.out.cart.line')
+    Inventory = pool.get('stock.inventory')
+
+    storage, = Location.search([('code', '=', 'STO')])
+    company = create_company()
+    with set_company(company):
+        create_warehouse(company, locations, products, shipments, lines,
+            rows, columns, seed)
+
+        with Measure('StockShipmentOutCart.get_products') as measure:
+            picks = ShipmentCart.get_products()
+        print(measure)
+        with Measure('StockShipmentOutCart.get_products (draft)') as measure:
+            ShipmentCart.get_products()
+        print(measure)
+        with Measure('StockShipmentOutCart.get_products_page') as measure:
+            cursor = True
+            while cursor:
+                cursor = ShipmentCart.get_products_page(
+                    cursor if cursor is not True else None, 50)['cursor']
+        print(measure)
+
+        pickings = [{
+                'shipment': s['code'],
+                'product': product_id,
+                'qty': s['quantity'],
+                'location': s['location'],
+                'status': 'done',
+                } for p in picks for product_id, v in p.iteritems()
+            for s in v['shipments']]
+        with Measure('StockShipmentOutCartLine.save_pickings') as measure:
+            ShipmentCartLine.save_pickings(pickings)
+        print(measure)
+
+        inventory, = Inventory.create([{
+                    'location': storage.id,
+                    'company': company.id,
+                    }])
+        with Measure('Inventory.complete_lines') as measure:
+            Inventory.complete_lines([inventory])
+        print(measure)
+
+        codes = list(set(s['code'] for p in picks for v in p.itervalues()
+                for s in v['shipments']))
+        with Measure('StockShipmentOutCart.done_cart') as measure:
+            ShipmentCart.done_cart(codes)
+        print(measure)
+
+
+# Indexes of the module: (table, index)
+INDEXES = [
+    ('stock_shipment_out_cart', 'stock_shipment_out_cart_user_state_index'),
+    ('stock_shipment_out_cart', 'stock_shipment_out_cart_user_draft_index'),
+    ('stock_shipment_out_cart', 'stock_shipment_out_cart_cart_draft_index'),
+    ('stock_shipment_out_cart_line',
+        'stock_shipment_out_cart_line_shipment_cart_user_index'),
+    ('stock_shipment_out_cart_line',
+        'stock_shipment_out_cart_line_from_location_product_index'),
+    ]
+
+
+def explain(query):
+    'Return the plan of the python-sql query'
+    cursor = Transaction().connection.cursor()
+    sql, params = tuple(query)
+    if backend.name() == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return '\n'.join(str(r[-1]) for r in cursor.fetchall())
+    cursor.execute('EXPLAIN ' + sql, params)
+    return '\n'.join(r[0] for r in cursor.fetchall())
+
+
+def benchmark_indexes(locations=1000, products=2000, shipments=500,
+        lines=3, seed=0):
+    '''
+    Print the plans and time of the hot queries of carts and cart lines with
+    and without the module indexes on a synthetic warehouse whose shipments
+    are all picked and done but one
+    '''
+    pool = Pool()
+    ShipmentCart = pool.get('stock.shipment.out.cart')
+    ShipmentCartLine = pool.get('stock.shipment.out.cart.line')
+    Shipment = pool.get('stock.shipment.out')
+    cart_table = ShipmentCart.__table__()
+    line = ShipmentCartLine.__table__()
+    shipment = Shipment.__table__()
+    cursor = Transaction().connection.cursor()
+    user = Transaction().user
+
+    company = create_company()
+    with set_company(company):
+        leaves, products, shipments, cart = create_warehouse(company,
+            locations, products, shipments, lines, 1, 1, seed)
+        ShipmentCart.create([{
+                    'shipment': s.id,
+                    'state': 'done' if i else 'draft',
+                    } for i, s in enumerate(shipments)])
+        pick_shipments(shipments, cart)
+        if backend.name() == 'postgresql':
+            for table in set(t for t, _ in INDEXES):
+                cursor.execute('ANALYZE "%s"' % table)
+
+        draft_shipment = shipments[0]
+        queries = [
+            ('Draft carts of the user', cart_table.select(cart_table.id,
+                    where=(cart_table.user == user)
+                    & (cart_table.state == 'draft'))),
+            ('Used boxes of the cart', cart_table.select(cart_table.row,
+                    cart_table.column,
+                    where=(cart_table.cart == cart.id)
+                    & (cart_table.state == 'draft'))),
+            ('Picked lines of a shipment', line.select(line.product,
+                    where=(line.shipment == draft_shipment.id)
+                    & (line.cart == cart.id) & (line.user == user))),
+            ('Picking quantities of a location', line.join(shipment,
+                    condition=line.shipment == shipment.id
+                    ).select(line.product, Sum(line.quantity),
+                    where=(line.from_location == leaves[0].id)
+                    & (shipment.state == 'assigned'),
+                    group_by=[line.product])),
+            ]
+
+        def run(title):
+            print(title)
+            for name, query in queries:
+                start = time()
+                for _ in range(100):
+                    cursor.execute(*query)
+                    cursor.fetchall()
+                print('    %-40s %10.3f ms' % (name,
+                        (time() - start) * 10))
+                print('        ' + explain(query).replace('\n', '\n        '))
+
+        run('With indexes')
+        for _, index in INDEXES:
+            cursor.execute('DROP INDEX IF EXISTS "%s"' % index)
+        run('Without indexes')
+
+
+def compare(results, previous):
+    'Print the ratio of results to the previous ones'
+    print('Compared with %s' % previous.get('name', ''))
+    for name, result in sorted(results.iteritems()):
+        if name not in previous['results']:
+            continue
+        before = previous['results'][name]
+        print('%-40s' % name + ''.join(' %10s' % (
+                    '%.2fx' % (float(result[key]) / before[key])
+                    if before[key] else '-')
+                for key in ['duration', 'queries', 'memory']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark stock_cart')
+    parser.add_argument('benchmarks', nargs='*',
+        choices=['warehouse', 'indexes', 'inventory', 'route', 'batch',
+            'payload'],
+        default=['warehouse', 'inventory', 'route', 'batch', 'payload'],
+        metavar='benchmark', help='warehouse, indexes, inventory, route, '
+        'batch or payload (all but indexes by default)')
+    parser.add_argument('--locations', type=int, default=1000)
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--shipments', type=int, default=500)
+    parser.add_argument('--lines', type=int, default=3,
+        help='mean lines by shipment')
+    parser.add_argument('--rows', type=int, default=4)
+    parser.add_argument('--columns', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--name', default='',
+        help='name of the results, the revision for example')
+    parser.add_argument('--output', help='JSON file to save the results')
+    parser.add_argument('--compare', help='JSON file of previous results')
+    options = parser.parse_args(argv)
+    benchmarks = options.benchmarks
+
+    if 'payload' in benchmarks:
+        benchmark_payload()
+    if 'route' in benchmarks:
+        benchmark_route()
+    if 'batch' in benchmarks:
+        benchmark_batch()
+    if set(benchmarks) & set(['inventory', 'warehouse', 'indexes']):
+        install_module('stock_cart')
+    for name, benchmark in [
+            ('inventory', benchmark_inventory),
+            ('warehouse', lambda: benchmark_warehouse(options.locations,
+                    options.products, options.shipments, options.lines,
+                    options.rows, options.columns, options.seed)),
+            ('indexes', lambda: benchmark_indexes(options.locations,
+                    options.products, options.shipments, options.lines,
+                    options.seed)),
+            ]:
+        if name not in benchmarks:
+            continue
+        with Transaction().start(DB_NAME, USER,
+                context=CONTEXT) as transaction:
+            try:
+                benchmark()
+            finally:
+                transaction.rollback()
+
+    results = dict((m.name, m.to_dict()) for m in Measure.results)
+    if options.compare:
+        with open(options.compare) as fp:
+            compare(results, json.load(fp))
+    if options.output:
+        with open(options.output, 'w') as fp:
+            json.dump({
+                    'name': options.name,
+                    'database': os.environ.get('TRYTOND_DATABASE_URI',
+                        'sqlite://'),
+                    'parameters': dict((k, getattr(options, k))
+                        for k in ['locations', 'products', 'shipments',
+                            'lines', 'rows', 'columns', 'seed']),
+                    'results': results,
+                    }, fp, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
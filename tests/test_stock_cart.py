@@ -4,6 +4,7 @@
 import unittest
 import doctest
 import datetime
+import random
 from decimal import Decimal
 from dateutil.relativedelta import relativedelta
 from functools import partial
@@ -14,10 +15,99 @@ from trytond.tests.test_tryton import ModuleTestCase, with_transaction
 from trytond.tests.test_tryton import doctest_setup, doctest_teardown
 from trytond.tests.test_tryton import doctest_checker
 from trytond.transaction import Transaction
+from trytond.config import config
 from trytond.exceptions import UserWarning
 from trytond.pool import Pool
 
 from trytond.modules.company.tests import create_company, set_company
+from trytond.modules.stock_cart.cart import (group_by_product,
+    compact_by_product)
+from trytond.modules.stock_cart.route import (route_length,
+    nearest_neighbour, two_opt, s_shape, optimize_route)
+from trytond.modules.stock_cart.batching import batch_orders
+from trytond.modules.stock_cart.metrics import (register_sink,
+    unregister_sink)
+
+
+def legacy_group_by_product(moves, product_info):
+    'Insertion sort pick list builder used before group_by_product'
+    products = []
+    for sequence, product_id, cart_id, shipment in moves:
+        index = len(products)
+        while index > 0 and products[index - 1][0] > sequence:
+            index -= 1
+        jindex = index
+        while jindex > 0 and product_id not in products[jindex - 1][1]:
+            jindex -= 1
+        location = shipment['location']
+        if jindex <= 0:
+            product = product_info(product_id)
+            product['shipments'] = [shipment]
+            product['carts'] = [cart_id]
+            product['quantity'] = shipment['quantity']
+            product['locations'] = [location]
+            products.insert(index, (sequence, {product_id: product}))
+        else:
+            product = products[jindex - 1][1][product_id]
+            product['shipments'].append(shipment)
+            product['carts'].append(cart_id)
+            product['quantity'] += shipment['quantity']
+            if location not in product['locations']:
+                product['locations'].append(location)
+    return [p[1] for p in products]
+
+
+def synthetic_cart_moves(carts, lines, products, locations, seed=0):
+    'Return random moves of carts with lines moves each'
+    rng = random.Random(seed)
+    moves = []
+    for cart_id in range(1, carts + 1):
+        for _ in range(rng.randint(1, lines)):
+            location = rng.randint(1, locations)
+            moves.append((location // 3 or 1, rng.randint(1, products),
+                    cart_id, {
+                        'id': cart_id,
+                        'code': 'S%s' % cart_id,
+                        'quantity': float(rng.randint(1, 5)),
+                        'location': 'LOC%s' % location,
+                        }))
+    return moves
+
+
+def expand_compact(compact):
+    'Return the group_by_product pick list of a compact pick list'
+    products = compact['products']
+    locations = compact['locations']
+    shipments = compact['shipments']
+    lines = compact['lines']
+    entries = []
+    for i, entry in enumerate(lines['entry']):
+        index = lines['product'][i]
+        product_id = products['id'][index]
+        if entry == len(entries):
+            product = dict((k, v[index]) for k, v in products.iteritems()
+                if k != 'id')
+            product.update({
+                    'shipments': [],
+                    'carts': [],
+                    'quantity': 0,
+                    'locations': [],
+                    })
+            entries.append({product_id: product})
+        product = entries[entry][product_id]
+        shipment = lines['shipment'][i]
+        location = locations['name'][lines['location'][i]]
+        product['shipments'].append({
+                'id': shipments['id'][shipment],
+                'code': shipments['code'][shipment],
+                'quantity': lines['quantity'][i],
+                'location': location,
+                })
+        product['carts'].append(shipments['cart'][shipment])
+        product['quantity'] += lines['quantity'][i]
+        if location not in product['locations']:
+            product['locations'].append(location)
+    return entries
 
 
 class StockCartTestCase(ModuleTestCase):
@@ -41,7 +131,10 @@ class StockCartTestCase(ModuleTestCase):
         Cart = pool.get('stock.cart')
         Sout_cart = pool.get('stock.shipment.out.cart')
         Sout_cart_line = pool.get('stock.shipment.out.cart.line')
+        Reservation = pool.get('stock.shipment.out.cart.reservation')
+        PickingQuantity = pool.get('stock.shipment.out.cart.picking_quantity')
         ShipmentOut = pool.get('stock.shipment.out')
+        Configuration = pool.get('stock.configuration')
 
         today = datetime.date.today()
         unit, = Uom.search([('name', '=', 'Unit')])
@@ -262,17 +355,72 @@ class StockCartTestCase(ModuleTestCase):
             self.assertEqual(len(products), 2)
             self.assertEqual(products[0][1]['quantity'], 2.0)
             self.assertEqual(len(plocs), 2)
+            shipment, = products[0][1]['shipments']
+            self.assertEqual((shipment['row'], shipment['column']), (1, 1))
+            changes = Sout_cart.get_products_changes()
+            self.assertEqual(changes['products'], products)
+            version = changes['version']
+            self.assertEqual(Sout_cart.get_products_changes(version), {
+                    'version': version,
+                    'removed': [],
+                    'added': [],
+                    'quantities': [],
+                    })
+            self.assertEqual(Sout_cart.claim_shipments(), [shipment1.id])
+            # No other shipment of the user locations for the next cart
+            self.assertEqual(Sout_cart.claim_carts(reserve=True), [])
+            # The carts are reclaimed when the lease expires
+            config = Configuration(1)
+            config.stock_cart_lease_time = 60
+            config.save()
+            Sout_cart.renew_leases()
+            Sout_cart.reclaim_carts()
+            sout_carts = Sout_cart.search([('state', '=', 'draft')])
+            self.assertEqual(len(sout_carts), 1)
+            Sout_cart.write(sout_carts, {
+                    'lease_date': (datetime.datetime.now()
+                        - datetime.timedelta(hours=2)),
+                    })
+            Sout_cart.reclaim_carts()
+            self.assertEqual(Sout_cart.search([], count=True), 0)
+            self.assertEqual(Sout_cart.claim_shipments(), [shipment1.id])
+            pages, cursor = [], None
+            while True:
+                page = Sout_cart.get_products_page(cursor, size=1)
+                self.assertTrue(page['products'])
+                pages.extend(page['products'])
+                cursor = page['cursor']
+                if not cursor:
+                    break
+            quantity = lambda products: sum(v['quantity']
+                for p in products for v in p.itervalues())
+            self.assertEqual(quantity(pages), quantity(products))
 
             # 2. Get products by cart
             sout_cart, = Sout_cart.create([{
                     'shipment': shipment2.id,
                     }])
+            # Boxes of the cart are not reused
+            Sout_cart.assign_slots([sout_cart])
+            self.assertEqual((sout_cart.row, sout_cart.column), (1, 2))
+            changes = Sout_cart.get_products_changes(version)
+            self.assertNotEqual(changes['version'], version)
+            self.assertEqual(changes['removed'], [])
+            self.assertEqual(changes['quantities'], [])
+            self.assertEqual(set(s['id'] for p in changes['added']
+                    for v in p.itervalues() for s in v['shipments']),
+                set([shipment2.id]))
 
             sout_carts = Sout_cart.search([])
             self.assertEqual(len(sout_carts), 2)
             products = Sout_cart.get_products_by_carts(sout_carts)
             self.assertEqual(len(products), 2)
             self.assertEqual(products[0][1]['quantity'], 4.0)
+            compact = Sout_cart.get_products_by_carts(sout_carts, protocol=3)
+            lines = compact['lines']
+            self.assertEqual(len(set(lines['entry'])), len(products))
+            self.assertEqual(sum(q for e, q in zip(lines['entry'],
+                        lines['quantity']) if e == 0), 4.0)
 
             # Picking lines
             pickings = {
@@ -280,14 +428,184 @@ class StockCartTestCase(ModuleTestCase):
                     'product': '1',
                     'qty': '2',
                     'location': 'LOC1',
+                    'status': 'done',
                     },
                 }
             Sout_cart_line.save_pickings(pickings)
+            line, = Sout_cart_line.search([])
+            self.assertEqual(line.shipment, shipment1)
+            self.assertEqual(line.uom, unit)
+            # Already picked lines are not created again
+            Sout_cart_line.save_pickings([
+                    dict(pickings[shipment1.number],
+                        shipment=shipment1.number),
+                    ])
+            self.assertEqual(Sout_cart_line.search([], count=True), 1)
+            # Picking quantities are updated with the lines
+            location = line.from_location
+            self.assertEqual(PickingQuantity.get_quantities([location]), {
+                    (location.id, line.product.id): 2.0,
+                    })
+            Sout_cart_line.write([line], {'quantity': 1})
+            self.assertEqual(PickingQuantity.get_quantities([location],
+                    [line.product]).values(), [1.0])
+            Sout_cart_line.write([line], {'quantity': 2})
+            self.assertEqual(PickingQuantity.check(), [])
 
             # Done carts
             Sout_cart.done(sout_carts)
             self.assertEqual(sout_cart.state, 'done')
 
+            # Draft and delete carts with their lines
+            Sout_cart_line.done([line])
+            self.assertEqual(Sout_cart.get_line_ids(sout_carts), [line.id])
+            Sout_cart.draft(sout_carts)
+            self.assertEqual(line.state, 'draft')
+            Sout_cart.delete(sout_carts)
+            self.assertEqual(Sout_cart_line.search([], count=True), 0)
+            self.assertEqual(PickingQuantity.get_quantities([location]), {})
+            self.assertEqual(PickingQuantity.check(), [])
+
+            # Reserve the next cart and hand it over once the carts are done
+            carts = Sout_cart.claim_carts(reserve=True)
+            self.assertEqual([c.shipment for c in carts], [shipment1])
+            self.assertEqual([c.state for c in carts], ['reserved'])
+            Sout_cart.reserve_pick_list(carts)
+            reservation, = Reservation.search([])
+            self.assertEqual(reservation.load_pick_list(),
+                Sout_cart.get_products_by_carts(carts))
+            if not config.has_section('stock_cart'):
+                config.add_section('stock_cart')
+            config.set('stock_cart', 'prepare_carts', 'True')
+            try:
+                products = Sout_cart.get_products()
+            finally:
+                config.remove_option('stock_cart', 'prepare_carts')
+            self.assertEqual(products, Sout_cart.get_products_by_carts(carts))
+            self.assertEqual(Sout_cart.search([
+                        ('state', '=', 'draft'),
+                        ], count=True), 1)
+            self.assertEqual(Reservation(reservation.id).pick_list, None)
+
+            # Claiming the reserved carts clears their pick list too
+            Sout_cart.delete(Sout_cart.search([]))
+            carts = Sout_cart.claim_carts(reserve=True)
+            Sout_cart.reserve_pick_list(carts)
+            self.assertNotEqual(Reservation(reservation.id).pick_list, None)
+            self.assertEqual(Sout_cart.claim_shipments(), [shipment1.id])
+            self.assertEqual(Reservation(reservation.id).pick_list, None)
+
+    def test0020group_by_product(self):
+        'Test group_by_product returns the legacy pick list'
+        product_info = lambda product_id: {
+            'name': 'Product %s' % product_id,
+            'code': 'P%s' % product_id,
+            }
+        for seed, (carts, lines, products, locations) in enumerate([
+                    (4, 3, 3, 5),
+                    (40, 25, 50, 120),
+                    (60, 30, 400, 30),
+                    (40, 20, 10, 1000),
+                    ]):
+            moves = synthetic_cart_moves(carts, lines, products, locations,
+                seed=seed)
+            self.assertEqual(group_by_product(moves, product_info),
+                legacy_group_by_product(moves, product_info))
+
+    def test0025compact_by_product(self):
+        'Test compact_by_product returns the group_by_product pick list'
+        product_info = lambda product_id: {
+            'name': 'Product %s' % product_id,
+            'code': 'P%s' % product_id,
+            }
+        for seed, (carts, lines, products, locations) in enumerate([
+                    (4, 3, 3, 5),
+                    (40, 25, 50, 120),
+                    ]):
+            moves = synthetic_cart_moves(carts, lines, products, locations,
+                seed=seed)
+            compact = compact_by_product(((sequence, product_id, cart_id,
+                        s['id'], s['code'], None, None,
+                        int(s['location'][3:]), s['quantity'])
+                    for sequence, product_id, cart_id, s in moves),
+                product_info, lambda location_id: 'LOC%s' % location_id)
+            self.assertEqual(expand_compact(compact),
+                group_by_product(moves, product_info))
+
+    @with_transaction()
+    def test0026empty_pick_list(self):
+        'Test the empty pick list has the format of the protocol'
+        Sout_cart = Pool().get('stock.shipment.out.cart')
+
+        self.assertEqual(Sout_cart.get_products(), [])
+        empty = compact_by_product([], None, None)
+        self.assertEqual(Sout_cart.get_products(protocol=3), empty)
+        self.assertEqual(expand_compact(empty), [])
+        self.assertEqual(Sout_cart.get_products_page(protocol=3), {
+                'products': empty,
+                'cursor': None,
+                })
+
+    def test0030route(self):
+        'Test pick routes'
+        points = [(3, 1), (0, 5), (3, 4), (0, 2), (6, 3)]
+        self.assertEqual(s_shape(points), [3, 1, 2, 0, 4])
+        self.assertEqual(nearest_neighbour(points), [3, 1, 2, 0, 4])
+
+        rng = random.Random(0)
+        points = [(rng.randrange(20) * 3, rng.randrange(50))
+            for _ in range(100)]
+        nearest = nearest_neighbour(points)
+        route = two_opt(points, nearest)
+        self.assertEqual(sorted(route), list(range(len(points))))
+        self.assertLessEqual(route_length(points, route),
+            route_length(points, nearest))
+        self.assertEqual(sorted(optimize_route(points, 'nearest', 0)),
+            list(range(len(points))))
+        route = optimize_route(points, 'nearest', 0, passes=2)
+        self.assertEqual(route, optimize_route(points, 'nearest', passes=2))
+        self.assertLessEqual(route_length(points, route),
+            route_length(points, nearest))
+
+    def test0040batch_orders(self):
+        'Test order batching'
+        orders = [
+            set([('location', 1), ('product', 1)]),
+            set([('location', 2), ('product', 2)]),
+            set([('location', 1), ('product', 3)]),
+            set([('location', 3), ('product', 1), ('aisle', 0)]),
+            set([('location', 1), ('product', 1)]),
+            ]
+        self.assertEqual(batch_orders(orders, 3), [0, 4, 2])
+        self.assertEqual(batch_orders(orders, 10), [0, 4, 2, 3, 1])
+        self.assertEqual(batch_orders([set(), set(), set()], 2), [0, 1])
+        self.assertEqual(batch_orders([], 2), [])
+
+    @with_transaction()
+    def test0050profile(self):
+        'Test the profile of the cart RPCs'
+        Sout_cart = Pool().get('stock.shipment.out.cart')
+
+        profiles = []
+        register_sink(profiles.append)
+        try:
+            Sout_cart.done_cart([])
+            self.assertEqual(profiles, [])
+
+            if not config.has_section('stock_cart'):
+                config.add_section('stock_cart')
+            config.set('stock_cart', 'profile', 'True')
+            Sout_cart.done_cart([])
+        finally:
+            config.remove_option('stock_cart', 'profile')
+            unregister_sink(profiles.append)
+        profile, = profiles
+        self.assertEqual(profile['rpc'], 'done_cart')
+        self.assertEqual([p['name'] for p in profile['phases']],
+            ['search_shipments'])
+        self.assertEqual(profile['queries'], profile['phases'][0]['queries'])
+
+
 def suite():
     suite = trytond.tests.test_tryton.suite()
     suite.addTests(unittest.TestLoader().loadTestsFromTestCase(